@@ -7,6 +7,10 @@ parser.add_argument('--xpid', default='douzero',
                     help='Experiment id (default: douzero)')
 parser.add_argument('--save_interval', default=30, type=int,
                     help='Time interval (in minutes) at which to save the model')    
+parser.add_argument('--log_sample_rate', default=1, type=int,
+                    help='Write the stats of one in every n learner steps to logs.csv')
+parser.add_argument('--metrics_store', action='store_true',
+                    help='Also write the stats to a columnar binary store in the metrics dir')
 parser.add_argument('--objective', default='adp', type=str, choices=['adp', 'wp', 'logadp'],
                     help='Use ADP or WP as reward (default: ADP)')    
 
@@ -19,6 +23,14 @@ parser.add_argument('--num_actor_devices', default=1, type=int,
                     help='The number of devices used for simulation')
 parser.add_argument('--num_actors', default=5, type=int,
                     help='The number of actors for each simulation device')
+parser.add_argument('--num_envs', default=1, type=int,
+                    help='The number of games simulated together in each actor')
+parser.add_argument('--num_inference_servers', default=0, type=int,
+                    help='The number of inference servers for each simulation device. 0 means each actor runs the model itself')
+parser.add_argument('--inference_batch_size', default=64, type=int,
+                    help='The maximum number of actor requests batched by an inference server')
+parser.add_argument('--inference_max_latency', default=2., type=float,
+                    help='Time (in milliseconds) an inference server waits to fill a batch')
 parser.add_argument('--training_device', default='0', type=str,
                     help='The index of the GPU used for training models. `cpu` means using cpu')
 parser.add_argument('--load_model', action='store_true',
@@ -27,6 +39,12 @@ parser.add_argument('--disable_checkpoint', action='store_true',
                     help='Disable saving checkpoint')
 parser.add_argument('--savedir', default='douzero_checkpoints',
                     help='Root dir where experiment data will be saved')
+parser.add_argument('--max_weight_checkpoints', default=0, type=int,
+                    help='The number of weight files kept for each position. 0 means keeping all of them')
+parser.add_argument('--checkpoint_format', default='torch', type=str, choices=['torch', 'flat'],
+                    help='Save checkpoints with torch.save or as flat memory-mappable files (default: torch)')
+parser.add_argument('--full_checkpoint_interval', default=1, type=int,
+                    help='With flat checkpoints, every n-th checkpoint has the optimizer states, the others only have the weights')
 
 # Hyperparameters
 parser.add_argument('--total_frames', default=100000000000, type=int,
@@ -41,8 +59,12 @@ parser.add_argument('--num_buffers', default=50, type=int,
                     help='Number of shared-memory buffers')
 parser.add_argument('--num_threads', default=4, type=int,
                     help='Number learner threads')
+parser.add_argument('--pin_memory', action='store_true',
+                    help='Gather learner batches into pinned memory for faster copies to the GPU')
 parser.add_argument('--max_grad_norm', default=40., type=float,
                     help='Max norm of gradients')
+parser.add_argument('--weight_publish_interval', default=1, type=int,
+                    help='The number of learner steps of a position between two updates of the actor weights')
 
 # Optimizer settings
 parser.add_argument('--learning_rate', default=0.0001, type=float,
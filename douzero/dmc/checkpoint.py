@@ -0,0 +1,281 @@
+"""
+Checkpoints written in the background. The training loop only
+takes a snapshot of the learner state on CPU, and a writer thread
+saves it. Files are written to a temporary name and renamed, so a
+job preempted in the middle of a write never leaves a truncated
+checkpoint behind.
+
+Besides `torch.save`, checkpoints can be written in a flat format:
+a directory with one file of raw tensor data per group (the model
+or the optimizer of a position) and a `manifest.json` that gives
+the dtype, shape and offset of every tensor and holds everything
+that is not a tensor. Loading maps the files with `mmap`, so the
+tensors are only read when they are used.
+"""
+import os
+import re
+import json
+import queue
+import shutil
+import threading
+import traceback
+
+import numpy as np
+import torch
+
+from .utils import log
+
+Positions = ['landlord', 'landlord_up', 'landlord_down']
+
+def _to_cpu(obj):
+    """ Copy the tensors of a (nested) state dict to CPU """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+def atomic_save(obj, path):
+    """
+    `torch.save` into a temporary file next to `path` and rename
+    it to `path` once it is on disk.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+MANIFEST = 'manifest.json'
+
+def _encode(obj, tensors):
+    """
+    Turn a (nested) state dict into JSON. The tensors are appended
+    to `tensors` and replaced by their index. Dicts with keys that
+    are not strings (e.g., the optimizer state) keep their keys
+    as a list of items.
+    """
+    if isinstance(obj, torch.Tensor):
+        tensors.append(obj)
+        return {'__tensor__': len(tensors) - 1}
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) for k in obj):
+            return {k: _encode(v, tensors) for k, v in obj.items()}
+        return {'__items__': [[k, _encode(v, tensors)] for k, v in obj.items()]}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(v, tensors) for v in obj]
+    return obj
+
+def _decode(obj, tensors):
+    if isinstance(obj, dict):
+        if '__tensor__' in obj:
+            return tensors[obj['__tensor__']]
+        if '__items__' in obj:
+            return {k: _decode(v, tensors) for k, v in obj['__items__']}
+        return {k: _decode(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_decode(v, tensors) for v in obj]
+    return obj
+
+def save_flat(groups, meta, path):
+    """
+    Save a flat checkpoint into the directory `path`. `groups` maps
+    group names to (nested) state dicts, each group is written into
+    `<name>.bin`, and `meta` must be JSON serializable. The directory
+    is written under a temporary name and renamed at the end.
+    """
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    manifest = dict(meta=meta, groups={})
+    for name, state in groups.items():
+        tensors = []
+        structure = _encode(state, tensors)
+        specs = []
+        offset = 0
+        with open(os.path.join(tmp_path, name + '.bin'), 'wb') as f:
+            for tensor in tensors:
+                array = tensor.detach().cpu().contiguous().numpy()
+                f.write(array.tobytes())
+                specs.append(dict(dtype=array.dtype.str, shape=list(array.shape), offset=offset))
+                offset += array.nbytes
+            f.flush()
+            os.fsync(f.fileno())
+        manifest['groups'][name] = dict(file=name + '.bin', tensors=specs, structure=structure)
+    with open(os.path.join(tmp_path, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+def load_flat(path, groups=None):
+    """
+    Load a flat checkpoint saved by `save_flat`. Returns the state
+    dicts of the groups (all of them by default) and the meta. The
+    tensors are copy-on-write views of the memory mapped files, so
+    nothing is read from disk before the tensors are used.
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    states = {}
+    for name, group in manifest['groups'].items():
+        if groups is not None and name not in groups:
+            continue
+        tensors = []
+        file_path = os.path.join(path, group['file'])
+        data = np.zeros(0, dtype=np.uint8)
+        if os.path.getsize(file_path) > 0:
+            data = np.memmap(file_path, dtype=np.uint8, mode='c')
+        for spec in group['tensors']:
+            dtype = np.dtype(spec['dtype'])
+            nbytes = dtype.itemsize * int(np.prod(spec['shape']))
+            array = data[spec['offset']:spec['offset'] + nbytes].view(dtype).reshape(spec['shape'])
+            tensors.append(torch.from_numpy(array))
+        states[name] = _decode(group['structure'], tensors)
+    return states, manifest['meta']
+
+def load_flat_checkpoint(path, optimizers=True):
+    """
+    Load a flat checkpoint written by `CheckpointWriter` in the same
+    layout as a `torch.save` checkpoint. Weight-only snapshots only
+    have `model_state_dict`.
+    """
+    groups = ['model_' + position for position in Positions]
+    if optimizers:
+        groups += ['optimizer_' + position for position in Positions]
+    states, checkpoint = load_flat(path, groups)
+    checkpoint['model_state_dict'] = {position: states['model_' + position] for position in Positions}
+    if 'optimizer_' + Positions[0] in states:
+        checkpoint['optimizer_state_dict'] = {position: states['optimizer_' + position]
+                                              for position in Positions}
+    return checkpoint
+
+def _flat_snapshots(directory, kind):
+    """ The (frames, path) of the flat snapshots of a kind, oldest first """
+    snapshots = []
+    if os.path.isdir(directory):
+        pattern = re.compile(kind + r'_(\d+)$')
+        for name in os.listdir(directory):
+            match = pattern.match(name)
+            if match:
+                snapshots.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(snapshots)
+
+def latest_full_checkpoint(directory):
+    """ The path of the latest full flat snapshot in `directory`, or None """
+    snapshots = _flat_snapshots(directory, 'full')
+    return snapshots[-1][1] if snapshots else None
+
+def snapshot(learner_model, optimizers, position_locks, **extra):
+    """
+    Copy the models and the optimizers to CPU. The lock of each
+    position is held while it is copied, so that no learner step
+    is half applied. `extra` is added to the snapshot as is.
+    """
+    model_state_dict = {}
+    optimizer_state_dict = {}
+    for position in Positions:
+        with position_locks[position]:
+            model_state_dict[position] = _to_cpu(learner_model.get_model(position).state_dict())
+            optimizer_state_dict[position] = _to_cpu(optimizers[position].state_dict())
+    state = dict(model_state_dict=model_state_dict,
+                 optimizer_state_dict=optimizer_state_dict)
+    state.update(extra)
+    return state
+
+class CheckpointWriter:
+    """
+    Saves the snapshots given to `submit` in a background thread.
+    With the `torch` format, the full checkpoint is saved to
+    `checkpointpath` and the weights of each position to
+    `<position>_weights_<frames>.ckpt` for evaluation. With the
+    `flat` format, every `full_checkpoint_interval`-th snapshot (and
+    the ones submitted with `full=True`) is saved as a full flat
+    snapshot `flat/full_<frames>`, of which only the latest is kept,
+    and the others as weight-only snapshots `flat/weights_<frames>`.
+    Only the `max_weight_checkpoints` latest weight files (or
+    weight-only snapshots) are kept, all of them if it is 0. At most
+    one snapshot waits to be written, so `submit` blocks if the
+    writer is behind.
+    """
+    def __init__(self, checkpointpath, max_weight_checkpoints=0,
+                 checkpoint_format='torch', full_checkpoint_interval=1):
+        self.checkpointpath = checkpointpath
+        self.weights_dir = os.path.dirname(checkpointpath)
+        self.flat_dir = os.path.join(self.weights_dir, 'flat')
+        self.max_weight_checkpoints = max_weight_checkpoints
+        self.checkpoint_format = checkpoint_format
+        self.full_checkpoint_interval = full_checkpoint_interval
+        self.num_snapshots = 0
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, state, full=False):
+        full = full or self.num_snapshots % self.full_checkpoint_interval == 0
+        self.num_snapshots += 1
+        self.queue.put((state, full))
+
+    def close(self):
+        """ Write the pending snapshots and stop the thread """
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            state, full = item
+            try:
+                if self.checkpoint_format == 'flat':
+                    self._write_flat(state, full)
+                else:
+                    self._write(state)
+            except Exception:
+                log.error('Failed to save checkpoint at %d frames', state['frames'])
+                traceback.print_exc()
+
+    def _write(self, state):
+        log.info('Saving checkpoint to %s', self.checkpointpath)
+        atomic_save(state, self.checkpointpath)
+
+        # Save the weights for evaluation purpose
+        for position in Positions:
+            model_weights_dir = os.path.join(
+                self.weights_dir, position+'_weights_'+str(state['frames'])+'.ckpt')
+            atomic_save(state['model_state_dict'][position], model_weights_dir)
+            if self.max_weight_checkpoints > 0:
+                self._remove_old_weights(position)
+
+    def _write_flat(self, state, full):
+        groups = {'model_' + position: state['model_state_dict'][position] for position in Positions}
+        meta = {k: v for k, v in state.items() if k not in ('model_state_dict', 'optimizer_state_dict')}
+        if full:
+            groups.update({'optimizer_' + position: state['optimizer_state_dict'][position]
+                           for position in Positions})
+            path = os.path.join(self.flat_dir, 'full_%d' % state['frames'])
+        else:
+            path = os.path.join(self.flat_dir, 'weights_%d' % state['frames'])
+        log.info('Saving checkpoint to %s', path)
+        save_flat(groups, meta, path)
+
+        if full:
+            for _, old_path in _flat_snapshots(self.flat_dir, 'full')[:-1]:
+                shutil.rmtree(old_path)
+        elif self.max_weight_checkpoints > 0:
+            for _, old_path in _flat_snapshots(self.flat_dir, 'weights')[:-self.max_weight_checkpoints]:
+                shutil.rmtree(old_path)
+
+    def _remove_old_weights(self, position):
+        pattern = re.compile(re.escape(position) + r'_weights_(\d+)\.ckpt$')
+        weights = []
+        for name in os.listdir(self.weights_dir):
+            match = pattern.match(name)
+            if match:
+                weights.append((int(match.group(1)), name))
+        weights.sort()
+        for _, name in weights[:-self.max_weight_checkpoints]:
+            os.remove(os.path.join(self.weights_dir, name))
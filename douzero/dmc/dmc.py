@@ -12,50 +12,67 @@ from torch import nn
 
 from .file_writer import FileWriter
 from .models import Model
-from .utils import get_batch, log, create_env, create_buffers, create_optimizers, act
+from .utils import get_batch, log, create_buffers, create_batch_buffers, create_optimizers, act
+from .inference import InferenceClient, serve
+from .index_queue import IndexQueue
+from .weight_store import WeightStore
+from .timing import StageTimings, ACTOR_STAGES, LEARNER_STAGES, NULL_TIMER, share
+from .checkpoint import CheckpointWriter, snapshot, latest_full_checkpoint, load_flat_checkpoint
 
 mean_episode_return_buf = {p:deque(maxlen=100) for p in ['landlord', 'landlord_up', 'landlord_down']}
+num_learn_steps = {p: 0 for p in ['landlord', 'landlord_up', 'landlord_down']}
 
 def compute_loss(logits, targets):
     loss = ((logits.squeeze(-1) - targets)**2).mean()
     return loss
 
 def learn(position,
-          actor_models,
+          weight_store,
           model,
           batch,
           optimizer,
           flags,
-          lock):
+          lock,
+          stage_timer=NULL_TIMER):
     """Performs a learning (optimization) step."""
     if flags.training_device != "cpu":
         device = torch.device('cuda:'+str(flags.training_device))
     else:
         device = torch.device('cpu')
-    obs_x_no_action = batch['obs_x_no_action'].to(device)
-    obs_action = batch['obs_action'].to(device)
-    obs_x = torch.cat((obs_x_no_action, obs_action), dim=2).float()
-    obs_x = torch.flatten(obs_x, 0, 1)
-    obs_z = torch.flatten(batch['obs_z'].to(device), 0, 1).float()
-    target = torch.flatten(batch['target'].to(device), 0, 1)
+    # The batch tensors are reused by the next `get_batch` of this
+    # thread, which only happens after `loss.item()` below has
+    # waited for the copies
+    non_blocking = batch['obs_z'].is_pinned()
+    with stage_timer.time('to_device'):
+        obs_x_no_action = batch['obs_x_no_action'].to(device, non_blocking=non_blocking)
+        obs_action = batch['obs_action'].to(device, non_blocking=non_blocking)
+        obs_x = torch.cat((obs_x_no_action, obs_action), dim=2).float()
+        obs_x = torch.flatten(obs_x, 0, 1)
+        obs_z = torch.flatten(batch['obs_z'].to(device, non_blocking=non_blocking), 0, 1).float()
+        target = torch.flatten(batch['target'].to(device, non_blocking=non_blocking), 0, 1)
     episode_returns = batch['episode_return'][batch['done']]
     mean_episode_return_buf[position].append(torch.mean(episode_returns).to(device))
         
     with lock:
-        learner_outputs = model(obs_z, obs_x, return_value=True)
-        loss = compute_loss(learner_outputs['values'], target)
-        stats = {
-            'mean_episode_return_'+position: torch.mean(torch.stack([_r for _r in mean_episode_return_buf[position]])).item(),
-            'loss_'+position: loss.item(),
-        }
-        
-        optimizer.zero_grad()
-        loss.backward()
-        nn.utils.clip_grad_norm_(model.parameters(), flags.max_grad_norm)
-        optimizer.step()
+        with stage_timer.time('forward_backward'):
+            learner_outputs = model(obs_z, obs_x, return_value=True)
+            loss = compute_loss(learner_outputs['values'], target)
+            stats = {
+                'mean_episode_return_'+position: torch.mean(torch.stack([_r for _r in mean_episode_return_buf[position]])).item(),
+                'loss_'+position: loss.item(),
+            }
+
+            optimizer.zero_grad()
+            loss.backward()
+
+        with stage_timer.time('optimizer_step'):
+            nn.utils.clip_grad_norm_(model.parameters(), flags.max_grad_norm)
+            optimizer.step()
 
-        for actor_model in actor_models.values():
-            actor_model.get_model(position).load_state_dict(model.state_dict())
+        num_learn_steps[position] += 1
+        if num_learn_steps[position] % flags.weight_publish_interval == 0:
+            with stage_timer.time('weight_publish'):
+                weight_store.publish(position, model)
         return stats
 
 def train(flags):  
@@ -72,6 +89,8 @@ def train(flags):
         xpid=flags.xpid,
         xp_args=flags.__dict__,
         rootdir=flags.savedir,
+        sample_rate=flags.log_sample_rate,
+        metrics_store=flags.metrics_store,
     )
     checkpointpath = os.path.expandvars(
         os.path.expanduser('%s/%s/%s' % (flags.savedir, flags.xpid, 'model.tar')))
@@ -103,8 +122,8 @@ def train(flags):
     full_queue = {}
         
     for device in device_iterator:
-        _free_queue = {'landlord': ctx.SimpleQueue(), 'landlord_up': ctx.SimpleQueue(), 'landlord_down': ctx.SimpleQueue()}
-        _full_queue = {'landlord': ctx.SimpleQueue(), 'landlord_up': ctx.SimpleQueue(), 'landlord_down': ctx.SimpleQueue()}
+        _free_queue = {p: IndexQueue(flags.num_buffers, ctx) for p in ['landlord', 'landlord_up', 'landlord_down']}
+        _full_queue = {p: IndexQueue(flags.num_buffers, ctx) for p in ['landlord', 'landlord_up', 'landlord_down']}
         free_queue[device] = _free_queue
         full_queue[device] = _full_queue
 
@@ -126,14 +145,22 @@ def train(flags):
     frames, stats = 0, {k: 0 for k in stat_keys}
     position_frames = {'landlord':0, 'landlord_up':0, 'landlord_down':0}
 
-    # Load models if any
-    if flags.load_model and os.path.exists(checkpointpath):
-        checkpoint_states = torch.load(
-            checkpointpath, map_location=("cuda:"+str(flags.training_device) if flags.training_device != "cpu" else "cpu")
-        )
+    # Load models if any. The flat checkpoints are memory mapped,
+    # and their optimizer states are only loaded once the actors
+    # have been started
+    checkpoint_states = None
+    if flags.load_model:
+        if flags.checkpoint_format == 'flat':
+            flat_checkpointpath = latest_full_checkpoint(os.path.join(os.path.dirname(checkpointpath), 'flat'))
+            if flat_checkpointpath is not None:
+                checkpoint_states = load_flat_checkpoint(flat_checkpointpath)
+        elif os.path.exists(checkpointpath):
+            checkpoint_states = torch.load(
+                checkpointpath, map_location=("cuda:"+str(flags.training_device) if flags.training_device != "cpu" else "cpu")
+            )
+    if checkpoint_states is not None:
         for k in ['landlord', 'landlord_up', 'landlord_down']:
             learner_model.get_model(k).load_state_dict(checkpoint_states["model_state_dict"][k])
-            optimizers[k].load_state_dict(checkpoint_states["optimizer_state_dict"][k])
             for device in device_iterator:
                 models[device].get_model(k).load_state_dict(learner_model.get_model(k).state_dict())
         stats = checkpoint_states["stats"]
@@ -141,38 +168,88 @@ def train(flags):
         position_frames = checkpoint_states["position_frames"]
         log.info(f"Resuming preempted job, current stats:\n{stats}")
 
-    # Starting actor processes
-    for device in device_iterator:
+    # Each actor and learner thread adds the time of its stages
+    # to its own slot
+    actor_timings = StageTimings(ACTOR_STAGES, len(device_iterator) * flags.num_actors)
+    learner_timings = StageTimings(LEARNER_STAGES, len(device_iterator) * flags.num_threads * 3)
+    stage_stats = {}
+    for timings, prefix in ((actor_timings, 'actor'), (learner_timings, 'learner')):
+        stage_stats.update(timings.report(prefix, timings.read(), timings.read(), 1.))
+
+    # How long the learners wait for full buffers in the full
+    # queues, and the actors wait for free buffers in the free
+    # queues. The learner threads of a device and position take
+    # their batches from the full queue one at a time, so at most
+    # one of them waits in the queue
+    queue_stats = {}
+
+    def read_queue_waits():
+        return {(device, position): (full_queue[device][position].wait_stats()[0],
+                                     free_queue[device][position].wait_stats()[0])
+                for device in device_iterator
+                for position in ['landlord', 'landlord_up', 'landlord_down']}
+
+    # The learner publishes its weights here and the actors and
+    # inference servers pick them up between forward passes
+    weight_store = WeightStore(learner_model)
+
+    # Starting inference servers. The actors then talk to the
+    # servers instead of holding the model themselves
+    for device_index, device in enumerate(device_iterator):
+        actor_models = [models[device] for _ in range(flags.num_actors)]
+        actor_weight_store = weight_store
+        if flags.num_inference_servers > 0:
+            request_queue = ctx.Queue()
+            response_queues = [ctx.SimpleQueue() for _ in range(flags.num_actors)]
+            for i in range(flags.num_inference_servers):
+                server = ctx.Process(
+                    target=serve,
+                    args=(i, device, models[device], request_queue, response_queues, flags, weight_store))
+                server.start()
+                actor_processes.append(server)
+            actor_models = [InferenceClient(i, request_queue, response_queues[i]) for i in range(flags.num_actors)]
+            actor_weight_store = None
+
+        # Starting actor processes
         num_actors = flags.num_actors
         for i in range(flags.num_actors):
             actor = ctx.Process(
                 target=act,
-                args=(i, device, free_queue[device], full_queue[device], models[device], buffers[device], flags))
+                args=(i, device, free_queue[device], full_queue[device], actor_models[i], buffers[device], flags,
+                      actor_weight_store, actor_timings.timer(device_index * flags.num_actors + i)))
             actor.start()
             actor_processes.append(actor)
 
-    def batch_and_learn(i, device, position, local_lock, position_lock, lock=threading.Lock()):
+    if checkpoint_states is not None:
+        for k in ['landlord', 'landlord_up', 'landlord_down']:
+            optimizers[k].load_state_dict(checkpoint_states["optimizer_state_dict"][k])
+        checkpoint_states = None
+
+    def batch_and_learn(i, device, position, local_lock, position_lock, stage_timer, lock=threading.Lock()):
         """Thread target for the learning process."""
         nonlocal frames, position_frames, stats
+        batch_buffers = create_batch_buffers(flags, buffers[device][position])
         while frames < flags.total_frames:
-            batch = get_batch(free_queue[device][position], full_queue[device][position], buffers[device][position], flags, local_lock)
-            _stats = learn(position, models, learner_model.get_model(position), batch, 
-                optimizers[position], flags, position_lock)
+            with stage_timer.time('get_batch'):
+                batch = get_batch(free_queue[device][position], full_queue[device][position], buffers[device][position], flags, local_lock,
+                                  batch_buffers)
+            _stats = learn(position, weight_store, learner_model.get_model(position), batch, 
+                optimizers[position], flags, position_lock, stage_timer)
 
             with lock:
                 for k in _stats:
                     stats[k] = _stats[k]
                 to_log = dict(frames=frames)
                 to_log.update({k: stats[k] for k in stat_keys})
+                to_log.update(stage_stats)
+                to_log.update(queue_stats)
                 plogger.log(to_log)
                 frames += T * B
                 position_frames[position] += T * B
 
     for device in device_iterator:
-        for m in range(flags.num_buffers):
-            free_queue[device]['landlord'].put(m)
-            free_queue[device]['landlord_up'].put(m)
-            free_queue[device]['landlord_down'].put(m)
+        for position in ['landlord', 'landlord_up', 'landlord_down']:
+            free_queue[device][position].put_many(list(range(flags.num_buffers)))
 
     threads = []
     locks = {}
@@ -180,33 +257,30 @@ def train(flags):
         locks[device] = {'landlord': threading.Lock(), 'landlord_up': threading.Lock(), 'landlord_down': threading.Lock()}
     position_locks = {'landlord': threading.Lock(), 'landlord_up': threading.Lock(), 'landlord_down': threading.Lock()}
 
-    for device in device_iterator:
+    for device_index, device in enumerate(device_iterator):
         for i in range(flags.num_threads):
-            for position in ['landlord', 'landlord_up', 'landlord_down']:
+            for position_index, position in enumerate(['landlord', 'landlord_up', 'landlord_down']):
+                stage_timer = learner_timings.timer((device_index * flags.num_threads + i) * 3 + position_index)
                 thread = threading.Thread(
-                    target=batch_and_learn, name='batch-and-learn-%d' % i, args=(i,device,position,locks[device][position],position_locks[position]))
+                    target=batch_and_learn, name='batch-and-learn-%d' % i, args=(i,device,position,locks[device][position],position_locks[position],stage_timer))
                 thread.start()
                 threads.append(thread)
     
-    def checkpoint(frames):
+    checkpoint_writer = None
+    if not flags.disable_checkpoint:
+        checkpoint_writer = CheckpointWriter(checkpointpath, flags.max_weight_checkpoints,
+                                             flags.checkpoint_format, flags.full_checkpoint_interval)
+
+    def checkpoint(frames, full=False):
         if flags.disable_checkpoint:
             return
-        log.info('Saving checkpoint to %s', checkpointpath)
-        _models = learner_model.get_models()
-        torch.save({
-            'model_state_dict': {k: _models[k].state_dict() for k in _models},
-            'optimizer_state_dict': {k: optimizers[k].state_dict() for k in optimizers},
-            "stats": stats,
-            'flags': vars(flags),
-            'frames': frames,
-            'position_frames': position_frames
-        }, checkpointpath)
-
-        # Save the weights for evaluation purpose
-        for position in ['landlord', 'landlord_up', 'landlord_down']:
-            model_weights_dir = os.path.expandvars(os.path.expanduser(
-                '%s/%s/%s' % (flags.savedir, flags.xpid, position+'_weights_'+str(frames)+'.ckpt')))
-            torch.save(learner_model.get_model(position).state_dict(), model_weights_dir)
+        checkpoint_writer.submit(snapshot(
+            learner_model, optimizers, position_locks,
+            stats=dict(stats),
+            flags=dict(vars(flags)),
+            frames=frames,
+            position_frames=dict(position_frames),
+        ), full)
 
     fps_log = []
     timer = timeit.default_timer
@@ -216,6 +290,8 @@ def train(flags):
             start_frames = frames
             position_start_frames = {k: position_frames[k] for k in position_frames}
             start_time = timer()
+            start_actor_times, start_learner_times = actor_timings.read(), learner_timings.read()
+            start_queue_waits = read_queue_waits()
             time.sleep(5)
 
             if timer() - last_checkpoint_time > flags.save_interval * 60:  
@@ -223,6 +299,21 @@ def train(flags):
                 last_checkpoint_time = timer()
             end_time = timer()
 
+            stage_stats.update(actor_timings.report('actor', start_actor_times, actor_timings.read(),
+                                                    end_time - start_time))
+            stage_stats.update(learner_timings.report('learner', start_learner_times, learner_timings.read(),
+                                                      end_time - start_time))
+            queue_waits = read_queue_waits()
+            for (device, position), (learner_wait, actor_wait) in queue_waits.items():
+                start_learner_wait, start_actor_wait = start_queue_waits[(device, position)]
+                prefix = 'queue_%s_%s' % (device, position)
+                queue_stats[prefix + '_full'] = full_queue[device][position].qsize()
+                queue_stats[prefix + '_free'] = free_queue[device][position].qsize()
+                queue_stats[prefix + '_learner_wait_pct'] = share(
+                    learner_wait - start_learner_wait, end_time - start_time)
+                queue_stats[prefix + '_actor_wait_pct'] = share(
+                    actor_wait - start_actor_wait, (end_time - start_time) * flags.num_actors)
+
             fps = (frames - start_frames) / (end_time - start_time)
             fps_log.append(fps)
             if len(fps_log) > 24:
@@ -241,13 +332,28 @@ def train(flags):
                      position_fps['landlord_up'],
                      position_fps['landlord_down'],
                      pprint.pformat(stats))
+            for prefix, stages in (('actor', ACTOR_STAGES), ('learner', LEARNER_STAGES)):
+                log.info('%s stages (ms per call, %% of time): %s', prefix.capitalize(), ', '.join(
+                    '%s %.2f (%.1f%%)' % (stage, stage_stats['%s_%s_ms' % (prefix, stage)],
+                                          stage_stats['%s_%s_pct' % (prefix, stage)])
+                    for stage in stages))
+            for device in device_iterator:
+                log.info('Queues of device %s (full, free buffers, %% of time a learner waits for a full buffer, '
+                         '%% of time actors wait for a free buffer): %s', str(device), ' | '.join(
+                    '%s %d, %d, %.1f%%, %.1f%%' % tuple([position] + [
+                        queue_stats['queue_%s_%s_%s' % (device, position, key)]
+                        for key in ('full', 'free', 'learner_wait_pct', 'actor_wait_pct')])
+                    for position in ['landlord', 'landlord_up', 'landlord_down']))
 
     except KeyboardInterrupt:
+        plogger.close(successful=False)
         return 
     else:
         for thread in threads:
             thread.join()
         log.info('Learning finished after %d frames.', frames)
 
-    checkpoint(frames)
+    checkpoint(frames, full=True)
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
     plogger.close()
@@ -3,7 +3,6 @@ Here, we wrap the original environment to make it easier
 to use. When a game is finished, instead of mannualy reseting
 the environment, we do it automatically.
 """
-import numpy as np
 import torch 
 
 def _format_observation(obs, device):
@@ -19,11 +18,16 @@ def _format_observation(obs, device):
     z_batch = torch.from_numpy(obs['z_batch']).to(device)
     x_no_action = torch.from_numpy(obs['x_no_action'])
     z = torch.from_numpy(obs['z'])
-    obs = {'x_batch': x_batch,
-           'z_batch': z_batch,
-           'legal_actions': obs['legal_actions'],
-           }
-    return position, obs, x_no_action, z
+    _obs = {'x_batch': x_batch,
+            'z_batch': z_batch,
+            'legal_actions': obs['legal_actions'],
+            }
+    if 'action_batch' in obs:
+        _obs['action_batch'] = torch.from_numpy(obs['action_batch']).to(device)
+    if 'legal_action_mask' in obs:
+        _obs['legal_action_ids'] = torch.tensor(obs['legal_action_ids'])
+        _obs['legal_action_mask'] = torch.from_numpy(obs['legal_action_mask'])
+    return position, _obs, x_no_action, z
 
 class Environment:
     def __init__(self, env, device):
@@ -69,3 +73,46 @@ class Environment:
 
     def close(self):
         self.env.close()
+
+class BatchedEnv:
+    def __init__(self, envs, device):
+        """ Wrap several environments that are stepped together
+        in one actor. Every game always has exactly one pending
+        decision, so each step takes one action per game.
+        """
+        self.envs = [Environment(env, device) for env in envs]
+
+    def __len__(self):
+        return len(self.envs)
+
+    def initial(self):
+        positions, obs, env_outputs = zip(*[env.initial() for env in self.envs])
+        return list(positions), list(obs), list(env_outputs)
+
+    def step(self, actions):
+        positions, obs, env_outputs = zip(*[env.step(action) for env, action in zip(self.envs, actions)])
+        return list(positions), list(obs), list(env_outputs)
+
+    def group_by_position(self, positions):
+        """ Return the indices of the games waiting for each
+        position so that one forward pass per position can
+        serve all of them.
+        """
+        groups = {}
+        for k, position in enumerate(positions):
+            groups.setdefault(position, []).append(k)
+        return groups
+
+    def stack_legal_masks(self, obs, indices=None):
+        """ Stack the legal action masks of the given games (all
+        of them by default) into one (len(indices), NUM_ACTIONS)
+        bool tensor. The environments have to be created with
+        `legal_mask=True`.
+        """
+        if indices is None:
+            indices = range(len(obs))
+        return torch.stack([obs[k]['legal_action_mask'] for k in indices])
+
+    def close(self):
+        for env in self.envs:
+            env.close()
@@ -19,11 +19,15 @@ import csv
 import json
 import logging
 import os
+import queue
+import threading
 import time
 from typing import Dict
 
 import git
 
+from .metrics_store import MetricsWriter
+
 
 def gather_metadata() -> Dict:
     date_start = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
@@ -59,10 +63,26 @@ def gather_metadata() -> Dict:
 
 
 class FileWriter:
+    """
+    Writes the metadata, the messages and the logged stats of an
+    experiment. `log` only puts the record in a queue: a background
+    thread collects the records for `flush_interval` seconds and
+    writes them to `logs.csv` at once, through a file handle that
+    stays open. At most `max_queue_size` records wait to be written,
+    so `log` blocks if the thread is behind. Only one in
+    `sample_rate` records is kept, and the records logged after
+    `close` are dropped.
+    With `metrics_store`, the records are also appended to the
+    columnar store in `metrics/` (see `douzero.dmc.metrics_store`).
+    """
     def __init__(self,
                  xpid: str = None,
                  xp_args: dict = None,
-                 rootdir: str = '~/palaas'):
+                 rootdir: str = '~/palaas',
+                 flush_interval: float = 1.0,
+                 sample_rate: int = 1,
+                 metrics_store: bool = False,
+                 max_queue_size: int = 10000):
         if not xpid:
             # make unique id
             xpid = '{proc}_{unixtime}'.format(
@@ -114,6 +134,7 @@ class FileWriter:
             logs='{base}/logs.csv'.format(base=self.basepath),
             fields='{base}/fields.csv'.format(base=self.basepath),
             meta='{base}/meta.json'.format(base=self.basepath),
+            metrics='{base}/metrics'.format(base=self.basepath),
         )
 
         self._logger.info('Saving arguments to %s', self.paths['meta'])
@@ -143,40 +164,117 @@ class FileWriter:
         else:
             self.fieldnames = ['_tick', '_time']
 
+        self._metrics = None
+        if metrics_store:
+            self._logger.info('Saving metrics to %s', self.paths['metrics'])
+            self._metrics = MetricsWriter(self.paths['metrics'])
+
+        # A resumed run goes on from the last logged tick
+        last_ticks = [self._last_logged_tick()]
+        if self._metrics is not None:
+            last_ticks.append(self._metrics.last_tick)
+        last_ticks = [tick for tick in last_ticks if tick is not None]
+        if last_ticks:
+            self._tick = max(last_ticks) + 1
+            self._logger.info('Resuming logs at tick %d', self._tick)
+
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self._logs_file = open(self.paths['logs'], 'a')
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='file-writer', daemon=True)
+        self._thread.start()
+
+    def _last_logged_tick(self):
+        """ The tick of the last row of `logs.csv`, read from its end """
+        if not os.path.exists(self.paths['logs']):
+            return None
+        with open(self.paths['logs'], 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 2 ** 16, 0))
+            lines = f.read().decode('utf8', errors='replace').splitlines()
+        for line in reversed(lines):
+            # The tick is the first field of a complete row
+            if ',' not in line:
+                continue
+            try:
+                return int(line.split(',', 1)[0])
+            except ValueError:
+                continue
+        return None
+
     def log(self, to_log: Dict, tick: int = None,
             verbose: bool = False) -> None:
+        if self._closed:
+            return
         if tick is not None:
             raise NotImplementedError
         else:
             to_log['_tick'] = self._tick
             self._tick += 1
+        if to_log['_tick'] % self.sample_rate != 0:
+            return
         to_log['_time'] = time.time()
 
+        if verbose:
+            self._logger.info('LOG | %s', ', '.join(
+                ['{}: {}'.format(k, to_log[k]) for k in sorted(to_log)]))
+
+        self._queue.put(dict(to_log))
+
+    def _run(self) -> None:
+        """
+        Write the records queued in every `flush_interval` seconds
+        until the `None` put by `close`. The records queued after it
+        are dropped.
+        """
+        closed = False
+        while not closed:
+            records = []
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                try:
+                    record = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if record is None:
+                    closed = True
+                    break
+                records.append(record)
+            if records:
+                try:
+                    self._write(records)
+                except Exception:
+                    self._logger.exception('Failed to write %d log records', len(records))
+
+    def _write(self, records) -> None:
         old_len = len(self.fieldnames)
-        for k in to_log:
-            if k not in self.fieldnames:
-                self.fieldnames.append(k)
+        for to_log in records:
+            for k in to_log:
+                if k not in self.fieldnames:
+                    self.fieldnames.append(k)
         if old_len != len(self.fieldnames):
             with open(self.paths['fields'], 'w') as csvfile:
                 writer = csv.writer(csvfile)
                 writer.writerow(self.fieldnames)
             self._logger.info('Updated log fields: %s', self.fieldnames)
 
-        if to_log['_tick'] == 0:
-            # print("\ncreating logs file ")
-            with open(self.paths['logs'], 'a') as f:
-                f.write('# %s\n' % ','.join(self.fieldnames))
-
-        if verbose:
-            self._logger.info('LOG | %s', ', '.join(
-                ['{}: {}'.format(k, to_log[k]) for k in sorted(to_log)]))
-
-        with open(self.paths['logs'], 'a') as f:
-            writer = csv.DictWriter(f, fieldnames=self.fieldnames)
+        writer = csv.DictWriter(self._logs_file, fieldnames=self.fieldnames)
+        for to_log in records:
+            if to_log['_tick'] == 0:
+                self._logs_file.write('# %s\n' % ','.join(self.fieldnames))
             writer.writerow(to_log)
-            # print("\nadded to log file")
+        self._logs_file.flush()
+        if self._metrics is not None:
+            self._metrics.append(records)
 
     def close(self, successful: bool = True) -> None:
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._logs_file.close()
+
         self.metadata['date_end'] = datetime.datetime.now().strftime(
             '%Y-%m-%d %H:%M:%S.%f')
         self.metadata['successful'] = successful
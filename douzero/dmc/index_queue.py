@@ -0,0 +1,105 @@
+"""
+A queue of buffer indices in shared memory. The actors and the
+learner threads pass the indices of the shared buffers around
+through free and full queues. Instead of pickling every index
+through a pipe, the indices are kept in a ring in a shared
+tensor, a semaphore counts the indices in the ring and a lock
+protects the head and tail counters.
+"""
+import time
+
+import numpy as np
+import torch
+
+class IndexQueue:
+    """
+    A FIFO of integers with room for `capacity` of them. It can
+    be passed to processes started from `ctx`. Every buffer index
+    is in at most one queue at a time, so a capacity of
+    `num_buffers` is enough.
+    """
+    def __init__(self, capacity, ctx):
+        self.capacity = capacity
+        self.slots = torch.zeros(capacity, dtype=torch.int64).share_memory_()
+        # Head and tail, i.e., the number of indices taken out and
+        # put in since the queue was created
+        self.counters = torch.zeros(2, dtype=torch.int64).share_memory_()
+        # The total time spent waiting in `get_many`, the number of
+        # calls, and the number and the sum of the start times of
+        # the calls that are waiting
+        self.waits = torch.zeros(4, dtype=torch.float64).share_memory_()
+        self.items = ctx.Semaphore(0)
+        self.lock = ctx.Lock()
+        self._views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_views'] = None
+        return state
+
+    @property
+    def views(self):
+        """ NumPy views of the shared tensors, made in each process """
+        if self._views is None:
+            self._views = (self.slots.numpy(), self.counters.numpy(), self.waits.numpy())
+        return self._views
+
+    def qsize(self):
+        """ The number of indices in the queue """
+        _, counters, _ = self.views
+        with self.lock:
+            return int(counters[1] - counters[0])
+
+    def wait_stats(self):
+        """
+        The total seconds spent waiting for indices, including the
+        gets that are still waiting, and the number of gets
+        """
+        _, _, waits = self.views
+        with self.lock:
+            now = time.perf_counter()
+            return float(waits[0] + waits[2] * now - waits[3]), int(waits[1])
+
+    def put(self, index):
+        self.put_many((index,))
+
+    def put_many(self, indices):
+        slots, counters, _ = self.views
+        with self.lock:
+            head, tail = int(counters[0]), int(counters[1])
+            if tail + len(indices) - head > self.capacity:
+                raise ValueError('IndexQueue is full')
+            for index in indices:
+                slots[tail % self.capacity] = index
+                tail += 1
+            counters[1] = tail
+        for _ in indices:
+            self.items.release()
+
+    def get(self):
+        return self.get_many(1)[0]
+
+    def get_many(self, num):
+        """
+        Block until `num` indices are available and take them out
+        at once. Two consumers that wait for several indices at the
+        same time can starve each other, so concurrent calls with
+        `num > 1` should be serialized by the caller (see
+        `get_batch`).
+        """
+        slots, counters, waits = self.views
+        start = time.perf_counter()
+        with self.lock:
+            waits[2] += 1
+            waits[3] += start
+        for _ in range(num):
+            self.items.acquire()
+        with self.lock:
+            waits[0] += time.perf_counter() - start
+            waits[1] += 1
+            waits[2] -= 1
+            waits[3] -= start
+            head = int(counters[0])
+            indices = slots[np.arange(head, head + num) % self.capacity].tolist()
+            counters[0] = head + num
+        return indices
@@ -0,0 +1,99 @@
+"""
+Optional inference server for the actors. Instead of every
+actor holding a copy of the model, the actors send their
+observations to a few server processes that batch the requests
+of many actors together and run one forward pass per position.
+"""
+import copy
+import queue
+import time
+import traceback
+
+import torch
+
+from .utils import log
+
+class InferenceClient:
+    """
+    Stands in for `Model` inside an actor. The observations are
+    sent to the server through a shared-memory queue and the
+    values come back through a queue owned by this actor.
+    """
+    def __init__(self, actor_id, request_queue, response_queue):
+        self.actor_id = actor_id
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+
+    def forward(self, position, z, x, training=False, flags=None, z_index=None, actions=None):
+        num_rows = x.shape[0] if actions is None else actions.shape[0]
+        if z_index is None:
+            z_index = torch.zeros(num_rows, dtype=torch.int64)
+        self.request_queue.put((self.actor_id, position, z, x, z_index, actions))
+        values = self.response_queue.get()
+        return dict(values=values)
+
+def serve(i, device, model, request_queue, response_queues, flags, weight_store=None):
+    """
+    This function will run forever until we stop it. It waits for
+    one request, then keeps collecting requests until either
+    `flags.inference_batch_size` requests are pending or
+    `flags.inference_max_latency` milliseconds have passed. The
+    requests are grouped by position and each group is evaluated
+    with one forward pass. With a `weight_store` the server uses its
+    own copy of `model` and updates it from the store between two
+    batches.
+    """
+    if not device == "cpu":
+        torch_device = torch.device('cuda:' + str(device))
+    else:
+        torch_device = torch.device('cpu')
+    max_latency = flags.inference_max_latency / 1000.
+    try:
+        log.info('Device %s Inference server %i started.', str(device), i)
+        if weight_store is not None:
+            model = copy.deepcopy(model)
+            weight_versions = {}
+        while True:
+            requests = [request_queue.get()]
+            if weight_store is not None:
+                weight_store.sync(model, weight_versions)
+            deadline = time.time() + max_latency
+            while len(requests) < flags.inference_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(request_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for request in requests:
+                groups.setdefault(request[1], []).append(request)
+
+            for position, group in groups.items():
+                # Shift the history indices of each request past the
+                # histories of the requests batched before it
+                z_offsets = [0]
+                for request in group[:-1]:
+                    z_offsets.append(z_offsets[-1] + request[2].shape[0])
+                z = torch.cat([request[2] for request in group]).to(torch_device)
+                x = torch.cat([request[3] for request in group]).to(torch_device)
+                z_index = torch.cat([request[4] + offset for request, offset in zip(group, z_offsets)]).to(torch_device)
+                actions = None
+                if group[0][5] is not None:
+                    actions = torch.cat([request[5] for request in group]).to(torch_device)
+                with torch.no_grad():
+                    values = model.forward(position, z, x, training=True,
+                                           z_index=z_index, actions=actions)['values'].cpu()
+                sizes = [request[4].shape[0] for request in group]
+                for request, _values in zip(group, torch.split(values, sizes)):
+                    response_queues[request[0]].put(_values.clone())
+
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        log.error('Exception in inference server %i', i)
+        traceback.print_exc()
+        print()
+        raise e
@@ -0,0 +1,250 @@
+"""
+A columnar binary store for the logged stats, written next to
+`logs.csv`. The records are split into chunks of `chunk_size`
+records. Every chunk is a directory with one append-only file of
+float64 values per stat and `_tick.i64`, the ticks of its records,
+and `store.json` gives the chunk size. The files can be memory
+mapped, so a range of records can be read without parsing, or
+even mapping, the chunks that were logged before it.
+
+The `_tick` file of a chunk is appended last, so the ticks give
+the number of complete records. A stat that appears in the middle
+of a chunk is padded with NaN for the earlier records of the
+chunk, a stat without a file in a chunk is NaN for the whole
+chunk, and a record without a stat gets NaN. Values that are not
+numbers are not stored, and the path separators in the names of
+the stats are replaced by `__`.
+
+The ticks are the index of the store and must increase: records
+whose tick is not above the last stored one are dropped.
+"""
+import os
+import json
+import bisect
+import numbers
+
+import numpy as np
+
+from .utils import log
+
+TICK = '_tick'
+_TICK_FILE = TICK + '.i64'
+_COLUMN_SUFFIX = '.f64'
+_STORE_FILE = 'store.json'
+
+# The default number of records per chunk
+CHUNK_SIZE = 2 ** 16
+
+def column_name(key):
+    """ The name of the column of a stat, without path separators """
+    for sep in (os.sep, os.altsep, '/'):
+        if sep:
+            key = key.replace(sep, '__')
+    return key
+
+def _chunk_paths(directory):
+    """ The paths of the chunk directories, in order """
+    names = [name for name in os.listdir(directory)
+             if name.isdigit() and os.path.isdir(os.path.join(directory, name))]
+    return [os.path.join(directory, name) for name in sorted(names, key=int)]
+
+def _num_ticks(chunk_path):
+    tick_path = os.path.join(chunk_path, _TICK_FILE)
+    return os.path.getsize(tick_path) // 8 if os.path.exists(tick_path) else 0
+
+def _chunk_columns(chunk_path):
+    return [name[:-len(_COLUMN_SUFFIX)] for name in os.listdir(chunk_path)
+            if name.endswith(_COLUMN_SUFFIX)]
+
+class MetricsWriter:
+    def __init__(self, directory, chunk_size=CHUNK_SIZE):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        store_path = os.path.join(directory, _STORE_FILE)
+        if os.path.exists(store_path):
+            with open(store_path) as f:
+                chunk_size = json.load(f)['chunk_size']
+        else:
+            with open(store_path, 'w') as f:
+                json.dump(dict(chunk_size=chunk_size), f)
+        self.chunk_size = chunk_size
+        self.num_rows = 0
+        self.last_tick = None
+        self._columns = set()
+        self._renamed = set()
+
+        chunk_paths = _chunk_paths(directory)
+        for chunk_path in chunk_paths:
+            num_ticks = _num_ticks(chunk_path)
+            self.num_rows += num_ticks
+            if num_ticks > 0:
+                ticks = np.memmap(os.path.join(chunk_path, _TICK_FILE), dtype=np.int64,
+                                  mode='r', shape=(num_ticks,))
+                self.last_tick = int(ticks[-1])
+        if chunk_paths:
+            # Drop the values of a record that was not complete
+            last_path = self._chunk_path(self.num_rows // self.chunk_size)
+            num_ticks = self.num_rows % self.chunk_size
+            if os.path.isdir(last_path):
+                for key in _chunk_columns(last_path):
+                    with open(os.path.join(last_path, key + _COLUMN_SUFFIX), 'r+b') as f:
+                        f.truncate(num_ticks * 8)
+                    self._columns.add(key)
+
+    def _chunk_path(self, chunk):
+        return os.path.join(self.directory, '%08d' % chunk)
+
+    def _rows(self, records):
+        """
+        The records that can be stored, as dicts of the tick and
+        of the numeric stats by column name
+        """
+        rows = []
+        num_dropped = 0
+        for record in records:
+            tick = int(record[TICK])
+            if self.last_tick is not None and tick <= self.last_tick:
+                num_dropped += 1
+                continue
+            self.last_tick = tick
+            row = {}
+            for key, value in record.items():
+                if key == TICK or not isinstance(value, numbers.Number):
+                    continue
+                name = column_name(key)
+                if name != key and key not in self._renamed:
+                    log.warning('Storing metric %s as %s', key, name)
+                    self._renamed.add(key)
+                row[name] = value
+            rows.append((tick, row))
+        if num_dropped > 0:
+            log.warning('Dropped %d metric records whose tick is not above %d',
+                        num_dropped, self.last_tick)
+        return rows
+
+    def append(self, records):
+        """ Append a list of records (dicts with a `_tick`) """
+        rows = self._rows(records)
+        start = 0
+        while start < len(rows):
+            offset = self.num_rows % self.chunk_size
+            chunk_rows = rows[start:start + self.chunk_size - offset]
+            self._append_chunk(self.num_rows // self.chunk_size, offset, chunk_rows)
+            self.num_rows += len(chunk_rows)
+            start += len(chunk_rows)
+
+    def _append_chunk(self, chunk, offset, rows):
+        chunk_path = self._chunk_path(chunk)
+        if offset == 0:
+            os.makedirs(chunk_path, exist_ok=True)
+            # The files of an incomplete record were truncated
+            self._columns = set(_chunk_columns(chunk_path))
+        for _, row in rows:
+            for key in row:
+                if key not in self._columns:
+                    with open(os.path.join(chunk_path, key + _COLUMN_SUFFIX), 'wb') as f:
+                        np.full(offset, np.nan, dtype=np.float64).tofile(f)
+                    self._columns.add(key)
+        for key in self._columns:
+            values = np.empty(len(rows), dtype=np.float64)
+            for k, (_, row) in enumerate(rows):
+                values[k] = row.get(key, np.nan)
+            with open(os.path.join(chunk_path, key + _COLUMN_SUFFIX), 'ab') as f:
+                values.tofile(f)
+        ticks = np.array([tick for tick, _ in rows], dtype=np.int64)
+        with open(os.path.join(chunk_path, _TICK_FILE), 'ab') as f:
+            ticks.tofile(f)
+
+class MetricsReader:
+    """
+    Read the metrics of a `MetricsWriter` directory. The chunks are
+    memory mapped when they are accessed, and `slice` selects the
+    records of a range of ticks with a binary search over the first
+    tick of the chunks and then within a chunk. It can also select
+    a range of another increasing stat, e.g., `frames`, which is
+    then read entirely.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, _STORE_FILE)) as f:
+            self.chunk_size = json.load(f)['chunk_size']
+        self.chunk_paths = []
+        self.chunk_rows = []
+        keys = set()
+        for chunk_path in _chunk_paths(directory):
+            num_ticks = _num_ticks(chunk_path)
+            if num_ticks == 0:
+                break
+            self.chunk_paths.append(chunk_path)
+            self.chunk_rows.append(num_ticks)
+            keys.update(_chunk_columns(chunk_path))
+        self.num_rows = sum(self.chunk_rows)
+        self.keys = sorted(keys)
+        self._first_ticks = None
+        self._increasing = {}
+
+    def __len__(self):
+        return self.num_rows
+
+    def _chunk_column(self, chunk, key):
+        """ The values of a stat (or the ticks) in a chunk as a read-only memmap """
+        num_rows = self.chunk_rows[chunk]
+        if key == TICK:
+            path, dtype = os.path.join(self.chunk_paths[chunk], _TICK_FILE), np.int64
+        else:
+            path, dtype = os.path.join(self.chunk_paths[chunk], key + _COLUMN_SUFFIX), np.float64
+        if not os.path.exists(path):
+            return np.full(num_rows, np.nan, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(num_rows,))
+
+    def _range(self, key, begin, end):
+        """ The values of a stat (or the ticks) of the records in [begin, end) """
+        if key != TICK and key not in self.keys:
+            raise KeyError(key)
+        parts = []
+        for chunk in range(begin // self.chunk_size, len(self.chunk_paths)):
+            chunk_start = chunk * self.chunk_size
+            if chunk_start >= end:
+                break
+            values = self._chunk_column(chunk, key)
+            parts.append(values[max(begin - chunk_start, 0):end - chunk_start])
+        if not parts:
+            return np.zeros(0, dtype=np.int64 if key == TICK else np.float64)
+        return np.concatenate(parts)
+
+    def column(self, key):
+        """ All the values of a stat (or the ticks) """
+        return self._range(key, 0, self.num_rows)
+
+    def _search(self, by, value):
+        """ The position of the first record whose `by` is at least `value` """
+        if by == TICK:
+            if self._first_ticks is None:
+                self._first_ticks = [int(self._chunk_column(chunk, TICK)[0])
+                                     for chunk in range(len(self.chunk_paths))]
+            chunk = bisect.bisect_left(self._first_ticks, value) - 1
+            if chunk < 0:
+                return 0
+            return chunk * self.chunk_size + int(np.searchsorted(
+                self._chunk_column(chunk, TICK), value, side='left'))
+        index = self.column(by)
+        if by not in self._increasing:
+            self._increasing[by] = bool(np.all(index[1:] >= index[:-1]))
+        if not self._increasing[by]:
+            raise ValueError('Cannot slice by %s: it is not increasing' % by)
+        return int(np.searchsorted(index, value, side='left'))
+
+    def slice(self, start=None, stop=None, keys=None, by=TICK):
+        """
+        The records with `start <= by < stop` as a dict of arrays,
+        with the stats in `keys` (all of them by default) and the
+        ticks. `by` must be increasing.
+        """
+        begin = 0 if start is None else self._search(by, start)
+        end = self.num_rows if stop is None else self._search(by, stop)
+        if keys is None:
+            keys = self.keys
+        result = {TICK: self._range(TICK, begin, end)}
+        for key in keys:
+            result[key] = self._range(key, begin, end)
+        return result
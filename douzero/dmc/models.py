@@ -7,6 +7,38 @@ import numpy as np
 
 import torch
 from torch import nn
+import torch.nn.functional as F
+
+def _broadcast_history(lstm_out, x, z_index):
+    """
+    The historical moves are the same for all the legal actions
+    of a decision, so the LSTM only runs once per decision. Here
+    we copy its output to the rows of the actions. `z_index` tells
+    which row of `z` each action belongs to. Without it, a single
+    row of `z` is shared by all the actions.
+    """
+    if z_index is not None:
+        return lstm_out[z_index]
+    if lstm_out.shape[0] != x.shape[0]:
+        return lstm_out.expand(x.shape[0], -1)
+    return lstm_out
+
+def _dense1(dense1, lstm_out, x, z_index, actions):
+    """
+    The first dense layer. When `actions` is given, `x` only has
+    the state features (one row per row of `z`) and the layer is
+    split in two: the state part is computed once per decision and
+    added to the part of each legal action. The action features
+    are the last columns of the input, as in the full observation.
+    """
+    if actions is None:
+        lstm_out = _broadcast_history(lstm_out, x, z_index)
+        return dense1(torch.cat([lstm_out,x], dim=-1))
+    num_action_features = actions.shape[-1]
+    state = F.linear(torch.cat([lstm_out,x], dim=-1),
+                     dense1.weight[:, :-num_action_features], dense1.bias)
+    action = F.linear(actions, dense1.weight[:, -num_action_features:])
+    return _broadcast_history(state, action, z_index) + action
 
 class LandlordLstmModel(nn.Module):
     def __init__(self):
@@ -19,11 +51,10 @@ class LandlordLstmModel(nn.Module):
         self.dense5 = nn.Linear(512, 512)
         self.dense6 = nn.Linear(512, 1)
 
-    def forward(self, z, x, return_value=False, flags=None):
+    def forward(self, z, x, return_value=False, flags=None, z_index=None, actions=None):
         lstm_out, (h_n, _) = self.lstm(z)
         lstm_out = lstm_out[:,-1,:]
-        x = torch.cat([lstm_out,x], dim=-1)
-        x = self.dense1(x)
+        x = _dense1(self.dense1, lstm_out, x, z_index, actions)
         x = torch.relu(x)
         x = self.dense2(x)
         x = torch.relu(x)
@@ -54,11 +85,10 @@ class FarmerLstmModel(nn.Module):
         self.dense5 = nn.Linear(512, 512)
         self.dense6 = nn.Linear(512, 1)
 
-    def forward(self, z, x, return_value=False, flags=None):
+    def forward(self, z, x, return_value=False, flags=None, z_index=None, actions=None):
         lstm_out, (h_n, _) = self.lstm(z)
         lstm_out = lstm_out[:,-1,:]
-        x = torch.cat([lstm_out,x], dim=-1)
-        x = self.dense1(x)
+        x = _dense1(self.dense1, lstm_out, x, z_index, actions)
         x = torch.relu(x)
         x = self.dense2(x)
         x = torch.relu(x)
@@ -97,9 +127,9 @@ class Model:
         self.models['landlord_up'] = FarmerLstmModel().to(torch.device(device))
         self.models['landlord_down'] = FarmerLstmModel().to(torch.device(device))
 
-    def forward(self, position, z, x, training=False, flags=None):
+    def forward(self, position, z, x, training=False, flags=None, z_index=None, actions=None):
         model = self.models[position]
-        return model.forward(z, x, training, flags)
+        return model.forward(z, x, training, flags, z_index, actions)
 
     def share_memory(self):
         self.models['landlord'].share_memory()
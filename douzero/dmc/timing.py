@@ -0,0 +1,151 @@
+"""
+Per-stage timers of the actors and the learner threads. Every
+actor or learner thread owns one slot of a shared float64 tensor
+that holds, for each stage, the total time spent in it, the
+number of calls and the start of the call in progress. As a slot
+has a single writer, no lock is needed, and the main process
+reads all the slots to report the time per call and the share of
+the time of each stage. The time of a call in progress is counted
+when the slots are read, so a long call is split over the
+intervals between two reads.
+
+The start times come from `time.perf_counter`, which is the same
+clock in all the processes (the monotonic clock of the system).
+"""
+import time
+
+import numpy as np
+import torch
+
+# `env_step` includes `move_gen`, the legal move generation of the
+# engine, and `forward` includes the round trip to the inference
+# server if there is one
+ACTOR_STAGES = ['env_step', 'move_gen', 'get_obs', 'forward', 'buffer_write', 'queue_wait']
+
+# With a GPU, `to_device` only measures the time to enqueue the
+# copies when the batch is pinned
+LEARNER_STAGES = ['get_batch', 'to_device', 'forward_backward', 'optimizer_step', 'weight_publish']
+
+class StageTimings:
+    """
+    The shared totals of `num_slots` timers over the given stages.
+    It can be passed to processes.
+    """
+    def __init__(self, stages, num_slots):
+        self.stages = list(stages)
+        self.num_slots = num_slots
+        self.totals = torch.zeros((num_slots, len(self.stages), 3), dtype=torch.float64).share_memory_()
+
+    def timer(self, slot):
+        return StageTimer(self, slot)
+
+    def read(self, slots=None):
+        """
+        The (seconds, calls, seconds with the calls in progress) of
+        each stage, summed over the given slots (all of them by
+        default)
+        """
+        now = time.perf_counter()
+        totals = self.totals.numpy()
+        if slots is not None:
+            totals = totals[slots]
+        totals = totals.reshape(-1, len(self.stages), 3).copy()
+        started = totals[:, :, 2]
+        totals[:, :, 2] = totals[:, :, 0] + np.where(started > 0, now - started, 0.)
+        return totals.sum(axis=0)
+
+    def report(self, prefix, previous, current, elapsed):
+        """
+        The stats of each stage between two `read`s that are
+        `elapsed` seconds apart: the mean time per call in ms of
+        the calls that ended and the percentage of the time of a
+        slot spent in the stage.
+        """
+        stats = {}
+        for k, stage in enumerate(self.stages):
+            seconds, calls, spent = current[k] - previous[k]
+            stats['%s_%s_ms' % (prefix, stage)] = 1000. * seconds / calls if calls > 0 else 0.
+            stats['%s_%s_pct' % (prefix, stage)] = share(spent, elapsed * self.num_slots)
+        return stats
+
+def share(seconds, total):
+    """
+    `seconds` as a percentage of `total`, at most 100 (the clocks
+    of two reads may disagree slightly)
+    """
+    return min(100. * seconds / total, 100.) if total > 0 else 0.
+
+class StageTimer:
+    """
+    The timer of one slot. The stages are timed with `time`, a
+    context manager, or reported with `add`.
+    """
+    def __init__(self, timings, slot):
+        self.timings = timings
+        self.slot = slot
+        self.index = {stage: k for k, stage in enumerate(timings.stages)}
+        self._row = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_row'] = None
+        return state
+
+    @property
+    def row(self):
+        """ A NumPy view of the slot, made in each process """
+        if self._row is None:
+            self._row = self.timings.totals[self.slot].numpy()
+        return self._row
+
+    def add(self, stage, seconds):
+        totals = self.row[self.index[stage]]
+        totals[0] += seconds
+        totals[1] += 1
+
+    def start(self, stage, start):
+        self.row[self.index[stage], 2] = start
+
+    def end(self, stage, start):
+        """ Count the call in progress of a stage that started at `start` """
+        totals = self.row[self.index[stage]]
+        end = time.perf_counter()
+        # Clear the start first, so that a read never counts the
+        # call twice
+        totals[2] = 0.
+        totals[0] += end - start
+        totals[1] += 1
+
+    def time(self, stage):
+        return _Timed(self, stage)
+
+class _Timed:
+    __slots__ = ('timer', 'stage', 'start')
+
+    def __init__(self, timer, stage):
+        self.timer = timer
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.timer.start(self.stage, self.start)
+        return self
+
+    def __exit__(self, *args):
+        self.timer.end(self.stage, self.start)
+
+class _NullTimer:
+    """ A timer that records nothing """
+    def add(self, stage, seconds):
+        pass
+
+    def time(self, stage):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+NULL_TIMER = _NullTimer()
@@ -1,27 +1,16 @@
-import os 
+import copy
 import typing
 import logging
 import traceback
 import numpy as np
-from collections import Counter
-import time
 
 import torch 
-from torch import multiprocessing as mp
 
-from .env_utils import Environment
+from .env_utils import BatchedEnv
+from .timing import NULL_TIMER
 from douzero.env import Env
 from douzero.env.env import _cards2array
 
-Card2Column = {3: 0, 4: 1, 5: 2, 6: 3, 7: 4, 8: 5, 9: 6, 10: 7,
-               11: 8, 12: 9, 13: 10, 14: 11, 17: 12}
-
-NumOnes2Array = {0: np.array([0, 0, 0, 0]),
-                 1: np.array([1, 0, 0, 0]),
-                 2: np.array([1, 1, 0, 0]),
-                 3: np.array([1, 1, 1, 0]),
-                 4: np.array([1, 1, 1, 1])}
-
 shandle = logging.StreamHandler()
 shandle.setFormatter(
     logging.Formatter(
@@ -33,31 +22,55 @@ log.addHandler(shandle)
 log.setLevel(logging.INFO)
 
 # Buffers are used to transfer data between actor processes
-# and learner processes. They are shared tensors in GPU
-Buffers = typing.Dict[str, typing.List[torch.Tensor]]
+# and learner processes. They are shared tensors in GPU. Each key
+# has one tensor of shape (num_buffers, T, ...), and a buffer is
+# an index into its first dim
+Buffers = typing.Dict[str, torch.Tensor]
 
 def create_env(flags):
-    return Env(flags.objective)
+    return Env(flags.objective, factored_obs=True)
+
+def create_batch_buffers(flags, buffers):
+    """
+    Preallocate the tensors that `get_batch` fills, one per key
+    with shape (batch_size, T, ...), on the device of the shared
+    buffers. They are pinned if `flags.pin_memory` is set and the
+    buffers are on CPU, so that the copies to the training device
+    can be asynchronous. Each learner thread has its own.
+    """
+    pin_memory = flags.pin_memory and torch.cuda.is_available()
+    batch_buffers = {}
+    for key, buffer in buffers.items():
+        batch_buffers[key] = torch.empty((flags.batch_size,) + buffer.shape[1:],
+                                         dtype=buffer.dtype, device=buffer.device,
+                                         pin_memory=pin_memory and buffer.device.type == 'cpu')
+    return batch_buffers
 
 def get_batch(free_queue,
               full_queue,
               buffers,
               flags,
-              lock):
+              lock,
+              batch_buffers=None):
     """
     This function will sample a batch from the buffers based
     on the indices received from the full queue. It will also
-    free the indices by sending it to full_queue.
+    free the indices by sending it to free_queue. The queues
+    are `IndexQueue`s, so the indices are taken and returned in
+    one call. The batch is gathered with one `index_select` per
+    key into `batch_buffers` (see `create_batch_buffers`), which
+    are overwritten by the next call. The tensors of the batch
+    have shape (batch_size, T, ...).
     """
+    if batch_buffers is None:
+        batch_buffers = create_batch_buffers(flags, buffers)
     with lock:
-        indices = [full_queue.get() for _ in range(flags.batch_size)]
-    batch = {
-        key: torch.stack([buffers[key][m] for m in indices], dim=1)
-        for key in buffers
-    }
-    for m in indices:
-        free_queue.put(m)
-    return batch
+        indices = full_queue.get_many(flags.batch_size)
+    index = torch.tensor(indices, dtype=torch.int64, device=buffers['done'].device)
+    for key in buffers:
+        torch.index_select(buffers[key], 0, index, out=batch_buffers[key])
+    free_queue.put_many(indices)
+    return batch_buffers
 
 def create_optimizers(flags, learner_model):
     """
@@ -96,85 +109,163 @@ def create_buffers(flags, device_iterator):
                 obs_action=dict(size=(T, 54), dtype=torch.int8),
                 obs_z=dict(size=(T, 5, 162), dtype=torch.int8),
             )
-            _buffers: Buffers = {key: [] for key in specs}
-            for _ in range(flags.num_buffers):
-                for key in _buffers:
-                    if not device == "cpu":
-                        _buffer = torch.empty(**specs[key]).to(torch.device('cuda:'+str(device))).share_memory_()
-                    else:
-                        _buffer = torch.empty(**specs[key]).to(torch.device('cpu')).share_memory_()
-                    _buffers[key].append(_buffer)
+            _buffers: Buffers = {}
+            for key in specs:
+                size = (flags.num_buffers,) + specs[key]['size']
+                if not device == "cpu":
+                    _buffer = torch.empty(size, dtype=specs[key]['dtype'], device=torch.device('cuda:'+str(device))).share_memory_()
+                else:
+                    _buffer = torch.empty(size, dtype=specs[key]['dtype'], device=torch.device('cpu')).share_memory_()
+                _buffers[key] = _buffer
             buffers[device][position] = _buffers
     return buffers
 
-def act(i, device, free_queue, full_queue, model, buffers, flags):
+class _StagingBuffer:
+    """
+    A ring of preallocated NumPy arrays, one per buffer key, where
+    an actor accumulates the rows of one position until there are
+    enough of them to fill a shared buffer. Whole episodes are
+    appended in place and `flush` writes T rows into a buffer with
+    one block copy per key (two if the rows wrap around the ring).
+    """
+    def __init__(self, buffers, capacity):
+        self.arrays = {key: np.empty((capacity,) + tuple(buffer.shape[2:]),
+                                     dtype=torch.empty(0, dtype=buffer.dtype).numpy().dtype)
+                       for key, buffer in buffers.items()}
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self, size):
+        capacity = max(size, 2 * self.capacity)
+        for key, array in self.arrays.items():
+            grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self.size] = np.roll(array, -self.start, axis=0)[:self.size]
+            self.arrays[key] = grown
+        self.capacity = capacity
+        self.start = 0
+
+    def append_episode(self, episode_return, rows):
+        """
+        Append the moves of a finished game. `rows` maps the
+        observation keys to arrays with one row per move, and
+        `done`, `episode_return` and `target` are derived from
+        `episode_return`.
+        """
+        num_rows = len(rows['obs_action'])
+        if self.size + num_rows > self.capacity:
+            self._grow(self.size + num_rows)
+        end = self.start + self.size
+        positions = np.arange(end, end + num_rows) % self.capacity
+        last = positions[-1]
+        self.arrays['done'][positions] = False
+        self.arrays['done'][last] = True
+        self.arrays['episode_return'][positions] = 0.0
+        self.arrays['episode_return'][last] = episode_return
+        self.arrays['target'][positions] = episode_return
+        for key, array in rows.items():
+            self.arrays[key][positions] = array
+        self.size += num_rows
+
+    def flush(self, buffers, index, T):
+        """ Move the oldest T rows into buffer `index` """
+        first = min(T, self.capacity - self.start)
+        for key, array in self.arrays.items():
+            buffer = buffers[key][index]
+            buffer[:first].copy_(torch.from_numpy(array[self.start:self.start + first]))
+            if first < T:
+                buffer[first:].copy_(torch.from_numpy(array[:T - first]))
+        self.start = (self.start + T) % self.capacity
+        self.size -= T
+
+def act(i, device, free_queue, full_queue, model, buffers, flags, weight_store=None,
+        stage_timer=NULL_TIMER):
     """
     This function will run forever until we stop it. It will generate
     data from the environment and send the data to buffer. It uses
     a free queue and full queue to syncup with the main process.
+    Each actor simulates `flags.num_envs` games together so that
+    the decisions of all the games waiting for the same position
+    are evaluated with a single forward pass. With a `weight_store`
+    the actor plays with its own copy of `model` and updates it from
+    the store whenever one of its games is over. The time spent in
+    each stage is added to `stage_timer` (see `timing.ACTOR_STAGES`).
     """
     positions = ['landlord', 'landlord_up', 'landlord_down']
     try:
         T = flags.unroll_length
         log.info('Device %s Actor %i started.', str(device), i)
 
-        env = create_env(flags)
-        env = Environment(env, device)
+        # With inference servers the observations stay on CPU and
+        # are moved to the device by the server
+        env_device = 'cpu' if flags.num_inference_servers > 0 else device
+        _envs = [create_env(flags) for _ in range(flags.num_envs)]
+        for env in _envs:
+            env.set_stage_timer(stage_timer)
+        envs = BatchedEnv(_envs, env_device)
+
+        staging = {p: _StagingBuffer(buffers[p], 2 * T) for p in positions}
 
-        done_buf = {p: [] for p in positions}
-        episode_return_buf = {p: [] for p in positions}
-        target_buf = {p: [] for p in positions}
-        obs_x_no_action_buf = {p: [] for p in positions}
-        obs_action_buf = {p: [] for p in positions}
-        obs_z_buf = {p: [] for p in positions}
-        size = {p: 0 for p in positions}
+        if weight_store is not None:
+            model = copy.deepcopy(model)
+            weight_versions = {}
+            weight_store.sync(model, weight_versions)
 
-        position, obs, env_output = env.initial()
+        # The moves of a game are kept aside until the game is over
+        # because the targets are only known at the end of the game
+        episode_bufs = [{p: dict(obs_x_no_action=[], obs_action=[], obs_z=[]) for p in positions}
+                        for _ in range(len(envs))]
+
+        env_positions, obs, env_outputs = envs.initial()
 
         while True:
-            while True:
-                obs_x_no_action_buf[position].append(env_output['obs_x_no_action'])
-                obs_z_buf[position].append(env_output['obs_z'])
-                with torch.no_grad():
-                    agent_output = model.forward(position, obs['z_batch'], obs['x_batch'], flags=flags)
-                _action_idx = int(agent_output['action'].cpu().detach().numpy())
-                action = obs['legal_actions'][_action_idx]
-                obs_action_buf[position].append(_cards2tensor(action))
-                size[position] += 1
-                position, obs, env_output = env.step(action)
-                if env_output['done']:
-                    for p in positions:
-                        diff = size[p] - len(target_buf[p])
-                        if diff > 0:
-                            done_buf[p].extend([False for _ in range(diff-1)])
-                            done_buf[p].append(True)
-
-                            episode_return = env_output['episode_return'] if p == 'landlord' else -env_output['episode_return']
-                            episode_return_buf[p].extend([0.0 for _ in range(diff-1)])
-                            episode_return_buf[p].append(episode_return)
-                            target_buf[p].extend([episode_return for _ in range(diff)])
-                    break
+            actions = [None for _ in range(len(envs))]
+            for position, indices in envs.group_by_position(env_positions).items():
+                num_legal_actions = [len(obs[k]['legal_actions']) for k in indices]
+                z_batch = torch.cat([obs[k]['z_batch'] for k in indices])
+                x_batch = torch.cat([obs[k]['x_batch'] for k in indices])
+                action_batch = torch.cat([obs[k]['action_batch'] for k in indices])
+                z_index = torch.repeat_interleave(
+                    torch.arange(len(indices), device=x_batch.device),
+                    torch.tensor(num_legal_actions, device=x_batch.device))
+                with torch.no_grad(), stage_timer.time('forward'):
+                    values = model.forward(position, z_batch, x_batch, training=True,
+                                           z_index=z_index, actions=action_batch)['values']
+                action_indices = _select_actions(values, num_legal_actions, flags)
+                for k, _action_idx in zip(indices, action_indices):
+                    action = obs[k]['legal_actions'][_action_idx]
+                    actions[k] = action
+                    episode_bufs[k][position]['obs_x_no_action'].append(env_outputs[k]['obs_x_no_action'].numpy())
+                    episode_bufs[k][position]['obs_action'].append(_cards2array(action))
+                    episode_bufs[k][position]['obs_z'].append(env_outputs[k]['obs_z'].numpy())
+
+            env_positions, obs, env_outputs = envs.step(actions)
+
+            if weight_store is not None and any(env_output['done'] for env_output in env_outputs):
+                weight_store.sync(model, weight_versions)
+
+            for k, env_output in enumerate(env_outputs):
+                if not env_output['done']:
+                    continue
+                for p in positions:
+                    episode_buf = episode_bufs[k][p]
+                    if len(episode_buf['obs_action']) > 0:
+                        episode_return = env_output['episode_return'] if p == 'landlord' else -env_output['episode_return']
+                        with stage_timer.time('buffer_write'):
+                            staging[p].append_episode(float(episode_return),
+                                                      {key: np.stack(rows) for key, rows in episode_buf.items()})
+                    episode_bufs[k][p] = dict(obs_x_no_action=[], obs_action=[], obs_z=[])
 
             for p in positions:
-                while size[p] > T: 
-                    index = free_queue[p].get()
-                    if index is None:
-                        break
-                    for t in range(T):
-                        buffers[p]['done'][index][t, ...] = done_buf[p][t]
-                        buffers[p]['episode_return'][index][t, ...] = episode_return_buf[p][t]
-                        buffers[p]['target'][index][t, ...] = target_buf[p][t]
-                        buffers[p]['obs_x_no_action'][index][t, ...] = obs_x_no_action_buf[p][t]
-                        buffers[p]['obs_action'][index][t, ...] = obs_action_buf[p][t]
-                        buffers[p]['obs_z'][index][t, ...] = obs_z_buf[p][t]
+                while len(staging[p]) > T:
+                    with stage_timer.time('queue_wait'):
+                        index = free_queue[p].get()
+                    with stage_timer.time('buffer_write'):
+                        staging[p].flush(buffers[p], index, T)
                     full_queue[p].put(index)
-                    done_buf[p] = done_buf[p][T:]
-                    episode_return_buf[p] = episode_return_buf[p][T:]
-                    target_buf[p] = target_buf[p][T:]
-                    obs_x_no_action_buf[p] = obs_x_no_action_buf[p][T:]
-                    obs_action_buf[p] = obs_action_buf[p][T:]
-                    obs_z_buf[p] = obs_z_buf[p][T:]
-                    size[p] -= T
 
     except KeyboardInterrupt:
         pass  
@@ -184,12 +275,18 @@ def act(i, device, free_queue, full_queue, model, buffers, flags):
         print()
         raise e
 
-def _cards2tensor(list_cards):
+def _select_actions(values, num_legal_actions, flags):
     """
-    Convert a list of integers to the tensor
-    representation
-    See Figure 2 in https://arxiv.org/pdf/2106.06135.pdf
+    Pick one action per game from the values of a batched
+    forward pass. `values` stacks the legal actions of all
+    the games and `num_legal_actions` tells where each game
+    starts. With probability `flags.exp_epsilon` a random
+    legal action is taken instead of the greedy one.
     """
-    matrix = _cards2array(list_cards)
-    matrix = torch.from_numpy(matrix)
-    return matrix
+    action_indices = []
+    for game_values in torch.split(values.squeeze(-1), num_legal_actions):
+        if flags.exp_epsilon > 0 and np.random.rand() < flags.exp_epsilon:
+            action_indices.append(int(np.random.randint(game_values.shape[0])))
+        else:
+            action_indices.append(int(torch.argmax(game_values)))
+    return action_indices
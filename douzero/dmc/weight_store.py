@@ -0,0 +1,103 @@
+"""
+Versioned weights shared between the learner and the actors.
+Instead of copying the state dict of the learner into the
+models of every device after each step, the learner publishes
+the weights of a position into a shared CPU store, and the
+actors and inference servers copy them into their own models
+when they are between two forward passes.
+
+Each position has two slots. A publication writes the slot that
+readers are not supposed to use and then bumps the version, so
+a reader copying the latest weights is only disturbed if two
+more publications start during its copy. Like a seqlock, the
+reader checks the counters after the copy and retries in that
+case, so it never keeps torn weights.
+"""
+import torch
+
+Positions = ['landlord', 'landlord_up', 'landlord_down']
+
+class WeightStore:
+    """
+    Shared double-buffered weights of the three models. It is
+    created from a `Model`, whose weights are the first version,
+    and can be passed to processes.
+    """
+    def __init__(self, model):
+        self.slots = {}
+        for position in Positions:
+            state_dict = model.get_model(position).state_dict()
+            numel = sum(tensor.numel() for tensor in state_dict.values())
+            self.slots[position] = torch.zeros((2, numel), dtype=torch.float32).share_memory_()
+        # Per position, the last published version and the last
+        # version whose publication has started
+        self.counters = torch.zeros((len(Positions), 2), dtype=torch.int64).share_memory_()
+        self._counters = None
+        for position in Positions:
+            self.publish(position, model.get_model(position))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_counters'] = None
+        return state
+
+    @property
+    def _counter_view(self):
+        """ A NumPy view of the counters, made in each process """
+        if self._counters is None:
+            self._counters = self.counters.numpy()
+        return self._counters
+
+    def version(self, position):
+        return int(self._counter_view[Positions.index(position), 0])
+
+    def publish(self, position, module):
+        """
+        Publish the weights of `module` as the next version of
+        `position`. Only one thread may publish a position at a
+        time (the learner holds the position lock).
+        """
+        counters = self._counter_view[Positions.index(position)]
+        version = int(counters[0]) + 1
+        counters[1] = version
+        slot = self.slots[position][version % 2]
+        offset = 0
+        with torch.no_grad():
+            for tensor in module.state_dict().values():
+                numel = tensor.numel()
+                slot[offset:offset + numel].copy_(tensor.reshape(-1))
+                offset += numel
+        counters[0] = version
+
+    def load(self, position, module):
+        """
+        Copy the latest weights of `position` into `module` and
+        return their version.
+        """
+        counters = self._counter_view[Positions.index(position)]
+        while True:
+            version = int(counters[0])
+            slot = self.slots[position][version % 2]
+            offset = 0
+            with torch.no_grad():
+                for tensor in module.state_dict().values():
+                    numel = tensor.numel()
+                    tensor.copy_(slot[offset:offset + numel].view_as(tensor))
+                    offset += numel
+            # The slot is written again by the publication of
+            # version + 2
+            if int(counters[1]) < version + 2:
+                return version
+
+    def sync(self, model, versions):
+        """
+        Bring the three models of `model` up to date. `versions`
+        maps the positions to the versions that `model` has and
+        is updated in place. Returns True if a model changed.
+        """
+        changed = False
+        for position in Positions:
+            if versions.get(position) != self.version(position):
+                versions[position] = self.load(position, model.get_model(position))
+                changed = True
+        return changed
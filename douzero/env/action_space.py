@@ -0,0 +1,122 @@
+"""
+The global DouDizhu action space. Every card combination that
+the move generator can produce gets an integer id, and the type,
+rank, length, card counts and 54-dim encoding of every action are
+precomputed, so that the engine can pass legal actions around as
+arrays of ids and encode them with a single gather.
+"""
+import itertools
+
+import numpy as np
+
+from douzero.env import move_detector as md
+from douzero.env.encoding import Ranks, counts2array, cards2counts_batch
+from douzero.env.utils import MIN_SINGLE_CARDS, MIN_PAIRS, MIN_TRIPLES
+
+# The ranks 3 to A can form sequences, 2 and the jokers cannot
+_SerialRanks = Ranks[:12]
+_NormalRanks = Ranks[:13]
+_MaxCards = 20
+
+def _kickers(ranks, num):
+    """
+    All the multisets of `num` cards from the given ranks, with at
+    most 4 cards of a normal rank and one card of each joker.
+    """
+    kickers = []
+    for combination in itertools.combinations_with_replacement(ranks, num):
+        counts = {card: combination.count(card) for card in set(combination)}
+        if all(n <= (1 if card >= 20 else 4) for card, n in counts.items()):
+            kickers.append(list(combination))
+    return kickers
+
+def _serials(ranks, min_serial, repeat):
+    for length in range(min_serial, len(ranks) + 1):
+        if length * repeat > _MaxCards:
+            break
+        for start in range(len(ranks) - length + 1):
+            yield ranks[start:start + length]
+
+def _enumerate_moves():
+    """
+    Enumerate the moves type by type, following the rules of
+    `MovesGener` (e.g., the kickers of a serial 3+1 can be any
+    cards outside of the serial).
+    """
+    moves = [[]]
+    moves.extend([card] for card in Ranks)
+    moves.extend([card] * 2 for card in _NormalRanks)
+    moves.extend([card] * 3 for card in _NormalRanks)
+    moves.extend([card] * 4 for card in _NormalRanks)
+    moves.append([20, 30])
+    for triple in _NormalRanks:
+        moves.extend([triple] * 3 + [card] for card in Ranks if card != triple)
+    for triple in _NormalRanks:
+        moves.extend([triple] * 3 + [card] * 2 for card in _NormalRanks if card != triple)
+    for serial in _serials(_SerialRanks, MIN_SINGLE_CARDS, 1):
+        moves.append(list(serial))
+    for serial in _serials(_SerialRanks, MIN_PAIRS, 2):
+        moves.append(serial * 2)
+    for serial in _serials(_SerialRanks, MIN_TRIPLES, 3):
+        moves.append(serial * 3)
+    for serial in _serials(_SerialRanks, MIN_TRIPLES, 4):
+        others = [card for card in Ranks if card not in serial]
+        moves.extend(serial * 3 + kicker for kicker in _kickers(others, len(serial)))
+    for serial in _serials(_SerialRanks, MIN_TRIPLES, 5):
+        others = [card for card in _NormalRanks if card not in serial]
+        moves.extend(serial * 3 + list(pairs) * 2
+                     for pairs in itertools.combinations(others, len(serial)))
+    for four in _NormalRanks:
+        others = [card for card in Ranks if card != four]
+        moves.extend([four] * 4 + kicker for kicker in _kickers(others, 2))
+    for four in _NormalRanks:
+        others = [card for card in _NormalRanks if card != four]
+        moves.extend([four] * 4 + list(pairs) * 2
+                     for pairs in itertools.combinations(others, 2))
+
+    actions = list(dict.fromkeys(tuple(sorted(move)) for move in moves))
+    return actions
+
+# All the actions as sorted tuples of cards. The id of `pass` is 0
+ACTIONS = _enumerate_moves()
+NUM_ACTIONS = len(ACTIONS)
+PASS_ID = 0
+
+Action2Id = {action: action_id for action_id, action in enumerate(ACTIONS)}
+
+# Number of cards of each of the 15 ranks
+ACTION_COUNTS = cards2counts_batch(ACTIONS).astype(np.int8)
+
+# The 54-dim card matrix of each action
+ACTION_ARRAYS = counts2array(ACTION_COUNTS)
+
+# The move type of each action as given by `move_detector.classify_move`,
+# which backs the table lookup of `move_detector.get_move_type`
+ACTION_MOVE_TYPES = tuple(md.classify_move(list(action)) for action in ACTIONS)
+
+# Type, rank and length of each action. A missing rank is 0 and
+# a missing length is 1
+ACTION_TYPES = np.array([t['type'] for t in ACTION_MOVE_TYPES], dtype=np.int8)
+ACTION_RANKS = np.array([t.get('rank', 0) for t in ACTION_MOVE_TYPES], dtype=np.int8)
+ACTION_LENS = np.array([t.get('len', 1) for t in ACTION_MOVE_TYPES], dtype=np.int8)
+
+def action2id(move):
+    """
+    The id of a move given as a list of cards. Returns -1 if the
+    move is not in the action space.
+    """
+    return Action2Id.get(tuple(sorted(move)), -1)
+
+def id2action(action_id):
+    """
+    The move of an id as a (new) sorted list of cards.
+    """
+    return list(ACTIONS[action_id])
+
+def actions2ids(moves):
+    """
+    The ids of a list of moves. Duplicated moves are removed,
+    keeping the first occurrence.
+    """
+    action_ids = dict.fromkeys(Action2Id[tuple(sorted(move))] for move in moves)
+    return np.fromiter(action_ids, dtype=np.int64, count=len(action_ids))
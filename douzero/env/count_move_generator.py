@@ -0,0 +1,270 @@
+"""
+Move generation on rank count vectors. Instead of generating
+every move of a type and filtering them afterwards (see
+`move_generator.MovesGener` and `move_selector`), the moves are
+built from the number of cards of each of the 15 ranks and only
+the ranks that beat the rival move are visited. The kickers are
+enumerated as multisets of ranks, so no combinations of single
+cards have to be generated and deduplicated.
+
+The moves follow the rules of `MovesGener` and the filters of
+`move_selector`, including the way the rank of a move is read
+(e.g., the highest triple of a serial 3+1, which may come from
+the kickers).
+"""
+import itertools
+
+from douzero.env import move_detector as md
+from douzero.env.encoding import Ranks
+from douzero.env.utils import MIN_SINGLE_CARDS, MIN_PAIRS, MIN_TRIPLES
+
+Card2Index = {card: index for index, card in enumerate(Ranks)}
+
+# Rank indices 0 to 11 (3 to A) can form sequences
+_NUM_SERIAL_RANKS = 12
+_BLACK_JOKER, _RED_JOKER = 13, 14
+
+# The serial ranks with every card repeated 1, 2 and 3 times, so
+# that a sequence is a slice
+_SerialCards = {num: [card for card in Ranks[:_NUM_SERIAL_RANKS] for _ in range(num)]
+                for num in (1, 2, 3)}
+
+def _cards2counts(list_cards):
+    counts = [0] * 15
+    for card in list_cards:
+        counts[Card2Index[card]] += 1
+    return counts
+
+def _gen_solo(counts, num, above=-1):
+    """ Singles, pairs and triples with a rank above `above` """
+    return [[Ranks[index]] * num for index in range(above + 1, 15)
+            if counts[index] >= num]
+
+def _gen_bomb(counts, above=-1):
+    moves = [[Ranks[index]] * 4 for index in range(above + 1, 13)
+             if counts[index] == 4]
+    if counts[_BLACK_JOKER] and counts[_RED_JOKER]:
+        moves.append([20, 30])
+    return moves
+
+def _serial_runs(counts, num):
+    """
+    The longest sequences of ranks that each have at least `num`
+    cards, as (start, stop) pairs of rank indices.
+    """
+    runs = []
+    start = None
+    for index in range(_NUM_SERIAL_RANKS + 1):
+        if index < _NUM_SERIAL_RANKS and counts[index] >= num:
+            if start is None:
+                start = index
+        elif start is not None:
+            runs.append((start, index))
+            start = None
+    return runs
+
+def _serials(counts, num, min_serial, length=0, above=-1):
+    """
+    The sequences of ranks that each have at least `num` cards,
+    as (start, length) pairs. The sequences have the given length,
+    or any length of at least `min_serial` if `length` is 0, and
+    start above `above`.
+    """
+    runs = _serial_runs(counts, num)
+    if not runs:
+        return []
+    if length:
+        lengths = [length]
+    else:
+        lengths = range(min_serial, max(stop - start for start, stop in runs) + 1)
+    serials = []
+    for _length in lengths:
+        for start, stop in runs:
+            for _start in range(max(start, above + 1), stop - _length + 1):
+                serials.append((_start, _length))
+    return serials
+
+def _gen_serial(counts, num, min_serial, length=0, above=-1):
+    cards = _SerialCards[num]
+    return [cards[start * num:(start + _length) * num]
+            for start, _length in _serials(counts, num, min_serial, length, above)]
+
+def _gen_kickers(counts, excluded, num):
+    """
+    All the multisets of `num` cards of the hand outside of the
+    `excluded` ranks, as sorted lists of cards. The multisets are
+    built rank by rank from the smaller ones, like a knapsack.
+    """
+    kickers = [[[]]] + [[] for _ in range(num)]
+    for index in range(15):
+        if index in excluded or not counts[index]:
+            continue
+        card = Ranks[index]
+        for size in range(num, 0, -1):
+            for num_cards in range(1, min(counts[index], size) + 1):
+                cards = [card] * num_cards
+                kickers[size].extend(kicker + cards for kicker in kickers[size - num_cards])
+    return kickers[num]
+
+def _has_triple_above(kicker, above):
+    return any(kicker.count(card) == 3 and Card2Index[card] > above
+               for card in set(kicker))
+
+def _gen_3_1(counts, above=-1):
+    moves = []
+    for triple in range(above + 1, 13):
+        if counts[triple] < 3:
+            continue
+        cards = [Ranks[triple]] * 3
+        for single in range(15):
+            if single < triple and counts[single]:
+                moves.append([Ranks[single]] + cards)
+            elif single > triple and counts[single]:
+                moves.append(cards + [Ranks[single]])
+    return moves
+
+def _gen_3_2(counts, above=-1):
+    moves = []
+    for triple in range(above + 1, 13):
+        if counts[triple] < 3:
+            continue
+        cards = [Ranks[triple]] * 3
+        for pair in range(13):
+            if pair < triple and counts[pair] >= 2:
+                moves.append([Ranks[pair]] * 2 + cards)
+            elif pair > triple and counts[pair] >= 2:
+                moves.append(cards + [Ranks[pair]] * 2)
+    return moves
+
+def _gen_serial_3_1(counts, length=0, above=-1):
+    """
+    Serial triples with as many kickers as triples. A move beats
+    the rival if its highest triple, which can be made of kickers,
+    is above `above`.
+    """
+    moves = []
+    for start, _length in _serials(counts, 3, MIN_TRIPLES, length):
+        serial = range(start, start + _length)
+        top = start + _length - 1
+        triples = _SerialCards[3][start * 3:(start + _length) * 3]
+        for kicker in _gen_kickers(counts, serial, _length):
+            if top <= above and not _has_triple_above(kicker, above):
+                continue
+            moves.append(sorted(triples + kicker))
+    return moves
+
+def _gen_serial_3_2(counts, length=0, above=-1):
+    moves = []
+    for start, _length in _serials(counts, 3, MIN_TRIPLES, length):
+        serial = range(start, start + _length)
+        if start + _length - 1 <= above:
+            continue
+        triples = _SerialCards[3][start * 3:(start + _length) * 3]
+        pairs = [Ranks[index] for index in range(13) if index not in serial and counts[index] >= 2]
+        for kicker in itertools.combinations(pairs, _length):
+            moves.append(sorted(triples + list(kicker) * 2))
+    return moves
+
+def _gen_4_2(counts, above=-1):
+    moves = []
+    for four in range(above + 1, 13):
+        if counts[four] != 4:
+            continue
+        for kicker in _gen_kickers(counts, (four,), 2):
+            moves.append(sorted([Ranks[four]] * 4 + kicker))
+    return moves
+
+def _gen_4_22(counts, above=-1):
+    moves = []
+    for four in range(above + 1, 13):
+        if counts[four] != 4:
+            continue
+        pairs = [Ranks[index] for index in range(13) if index != four and counts[index] >= 2]
+        for kicker in itertools.combinations(pairs, 2):
+            moves.append(sorted([Ranks[four]] * 4 + list(kicker) * 2))
+    return moves
+
+def _gen_all(counts):
+    moves = []
+    moves.extend(_gen_solo(counts, 1))
+    moves.extend(_gen_solo(counts, 2))
+    moves.extend(_gen_solo(counts, 3))
+    moves.extend(_gen_bomb(counts))
+    moves.extend(_gen_3_1(counts))
+    moves.extend(_gen_3_2(counts))
+    moves.extend(_gen_serial(counts, 1, MIN_SINGLE_CARDS))
+    moves.extend(_gen_serial(counts, 2, MIN_PAIRS))
+    moves.extend(_gen_serial(counts, 3, MIN_TRIPLES))
+    moves.extend(_gen_serial_3_1(counts))
+    moves.extend(_gen_serial_3_2(counts))
+    moves.extend(_gen_4_2(counts))
+    moves.extend(_gen_4_22(counts))
+    return moves
+
+def _highest(rival_counts, num):
+    return max(index for index, n in enumerate(rival_counts) if n == num)
+
+def gen_legal_moves(hand_cards, rival_move):
+    """
+    Generate the moves of a hand that can follow the rival move,
+    as sorted lists of cards. This is a drop-in replacement of the
+    generator of `GameEnv.get_legal_card_play_actions`: it returns
+    the same moves, without duplicates.
+    """
+    counts = _cards2counts(hand_cards)
+    rival_move = sorted(rival_move)
+    rival_type = md.get_move_type(rival_move)
+    rival_move_type = rival_type['type']
+    rival_move_len = rival_type.get('len', 1)
+    moves = []
+
+    if rival_move_type == md.TYPE_0_PASS:
+        moves = _gen_all(counts)
+
+    elif rival_move_type == md.TYPE_1_SINGLE:
+        moves = _gen_solo(counts, 1, Card2Index[rival_move[0]])
+
+    elif rival_move_type == md.TYPE_2_PAIR:
+        moves = _gen_solo(counts, 2, Card2Index[rival_move[0]])
+
+    elif rival_move_type == md.TYPE_3_TRIPLE:
+        moves = _gen_solo(counts, 3, Card2Index[rival_move[0]])
+
+    elif rival_move_type == md.TYPE_4_BOMB:
+        moves = _gen_bomb(counts, Card2Index[rival_move[0]])
+
+    elif rival_move_type == md.TYPE_6_3_1:
+        moves = _gen_3_1(counts, Card2Index[rival_move[1]])
+
+    elif rival_move_type == md.TYPE_7_3_2:
+        moves = _gen_3_2(counts, Card2Index[rival_move[2]])
+
+    elif rival_move_type == md.TYPE_8_SERIAL_SINGLE:
+        moves = _gen_serial(counts, 1, MIN_SINGLE_CARDS, rival_move_len, Card2Index[rival_move[0]])
+
+    elif rival_move_type == md.TYPE_9_SERIAL_PAIR:
+        moves = _gen_serial(counts, 2, MIN_PAIRS, rival_move_len, Card2Index[rival_move[0]])
+
+    elif rival_move_type == md.TYPE_10_SERIAL_TRIPLE:
+        moves = _gen_serial(counts, 3, MIN_TRIPLES, rival_move_len, Card2Index[rival_move[0]])
+
+    elif rival_move_type == md.TYPE_11_SERIAL_3_1:
+        moves = _gen_serial_3_1(counts, rival_move_len, _highest(_cards2counts(rival_move), 3))
+
+    elif rival_move_type == md.TYPE_12_SERIAL_3_2:
+        moves = _gen_serial_3_2(counts, rival_move_len, _highest(_cards2counts(rival_move), 3))
+
+    elif rival_move_type == md.TYPE_13_4_2:
+        moves = _gen_4_2(counts, Card2Index[rival_move[2]])
+
+    elif rival_move_type == md.TYPE_14_4_22:
+        moves = _gen_4_22(counts, _highest(_cards2counts(rival_move), 4))
+
+    if rival_move_type not in [md.TYPE_0_PASS,
+                               md.TYPE_4_BOMB, md.TYPE_5_KING_BOMB]:
+        moves = moves + _gen_bomb(counts)
+
+    if len(rival_move) != 0:  # rival_move is not 'pass'
+        moves = moves + [[]]
+
+    return moves
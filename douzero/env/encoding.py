@@ -0,0 +1,77 @@
+"""
+Table based card encoding. A hand or a move is first turned
+into a vector with the number of cards of each of the 15 ranks
+(3, 4, ..., A, 2, black joker, red joker) and the vector is then
+mapped to the 54-dim card matrix by table lookup. See Figure 2
+in https://arxiv.org/pdf/2106.06135.pdf for the card matrix.
+"""
+import numpy as np
+
+# The 15 ranks in increasing order
+Ranks = [3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 17, 20, 30]
+
+# Card value -> rank index
+Card2Rank = np.zeros(31, dtype=np.int64)
+for _rank, _card in enumerate(Ranks):
+    Card2Rank[_card] = _rank
+
+# Number of cards of a rank -> the 4 entries of its column
+NumOnes2Row = np.array([[0, 0, 0, 0],
+                        [1, 0, 0, 0],
+                        [1, 1, 0, 0],
+                        [1, 1, 1, 0],
+                        [1, 1, 1, 1]], dtype=np.int8)
+
+def cards2counts(list_cards):
+    """
+    The number of cards of each rank, a vector of length 15.
+    The cards can be given as a list or a tuple.
+    """
+    return np.bincount(Card2Rank[np.asarray(list_cards, dtype=np.int64)], minlength=15)
+
+def counts2array(counts, out=None):
+    """
+    Encode a count vector (or a (N, 15) matrix of count vectors)
+    into the 54-dim card matrix: 13 columns of 4 entries for the
+    ranks 3 to 2 followed by the two jokers.
+    """
+    counts = np.asarray(counts)
+    if out is None:
+        out = np.empty(counts.shape[:-1] + (54,), dtype=np.int8)
+    out[..., :52] = NumOnes2Row[counts[..., :13]].reshape(counts.shape[:-1] + (52,))
+    out[..., 52:] = counts[..., 13:]
+    return out
+
+def cards2array(list_cards):
+    """
+    A utility function that transforms the actions, i.e.,
+    A list of integers into card matrix. Here we remove
+    the six entries that are always zero and flatten the
+    the representations.
+    """
+    if len(list_cards) == 0:
+        return np.zeros(54, dtype=np.int8)
+    return counts2array(cards2counts(list_cards))
+
+def cards2counts_batch(list_of_cards):
+    """
+    Count vectors of a list of hands or moves, a (N, 15) matrix.
+    All the cards are counted with one `bincount` call.
+    """
+    num_rows = len(list_of_cards)
+    lengths = [len(list_cards) for list_cards in list_of_cards]
+    cards = np.fromiter((card for list_cards in list_of_cards for card in list_cards),
+                        dtype=np.int64, count=sum(lengths))
+    rows = np.repeat(np.arange(num_rows), lengths)
+    counts = np.bincount(rows * 15 + Card2Rank[cards], minlength=num_rows * 15)
+    return counts.reshape(num_rows, 15)
+
+def cards2array_batch(list_of_cards, out=None):
+    """
+    Encode a list of hands or moves, e.g., the legal actions,
+    into a (N, 54) matrix. The rows are written into `out` if
+    it is given, so that a preallocated matrix can be reused.
+    """
+    if out is None:
+        out = np.empty((len(list_of_cards), 54), dtype=np.int8)
+    return counts2array(cards2counts_batch(list_of_cards), out=out)
@@ -1,16 +1,10 @@
-from collections import Counter
-import numpy as np
-
-from douzero.env.game import GameEnv
+import time
 
-Card2Column = {3: 0, 4: 1, 5: 2, 6: 3, 7: 4, 8: 5, 9: 6, 10: 7,
-               11: 8, 12: 9, 13: 10, 14: 11, 17: 12}
+import numpy as np
 
-NumOnes2Array = {0: np.array([0, 0, 0, 0]),
-                 1: np.array([1, 0, 0, 0]),
-                 2: np.array([1, 1, 0, 0]),
-                 3: np.array([1, 1, 1, 0]),
-                 4: np.array([1, 1, 1, 1])}
+from douzero.env.game import GameEnv, Position2Seat
+from douzero.env.encoding import cards2array, counts2array
+from douzero.env.action_space import ACTION_ARRAYS, NUM_ACTIONS, action2id
 
 deck = []
 for i in range(3, 15):
@@ -22,10 +16,12 @@ class Env:
     """
     Doudizhu multi-agent wrapper
     """
-    def __init__(self, objective):
+    def __init__(self, objective, factored_obs=False, legal_mask=False):
         """
         Objective is wp/adp/logadp. It indicates whether considers
-        bomb in reward calculation. Here, we use dummy agents.
+        bomb in reward calculation. `factored_obs` selects the
+        factored observations of `get_obs` and `legal_mask` adds
+        the legal action mask to them. Here, we use dummy agents.
         This is because, in the orignial game, the players
         are `in` the game. Here, we want to isolate
         players and environments to have a more gym style
@@ -35,6 +31,8 @@ class Env:
         will perform the actual action in the game engine.
         """
         self.objective = objective
+        self.factored_obs = factored_obs
+        self.legal_mask = legal_mask
 
         # Initialize players
         # We use three dummy player for the target position
@@ -47,6 +45,15 @@ class Env:
 
         self.infoset = None
 
+        # An optional timer (see `douzero.dmc.timing`) that gets the
+        # time of the engine as `env_step` and `move_gen` and the
+        # time of `get_obs` as `get_obs`
+        self.stage_timer = None
+
+    def set_stage_timer(self, stage_timer):
+        self.stage_timer = stage_timer
+        self._env.stage_timer = stage_timer
+
     def reset(self):
         """
         Every time reset is called, the environment
@@ -67,10 +74,16 @@ class Env:
             card_play_data[key].sort()
 
         # Initialize the cards
+        start = time.perf_counter()
         self._env.card_play_init(card_play_data)
         self.infoset = self._game_infoset
 
-        return get_obs(self.infoset)
+        obs_start = time.perf_counter()
+        obs = get_obs(self.infoset, self.factored_obs, self.legal_mask)
+        if self.stage_timer is not None:
+            self.stage_timer.add('env_step', obs_start - start)
+            self.stage_timer.add('get_obs', time.perf_counter() - obs_start)
+        return obs
 
     def step(self, action):
         """
@@ -80,10 +93,13 @@ class Env:
         current game is finished. It also returns an empty
         dictionary that is reserved to pass useful information.
         """
-        assert action in self.infoset.legal_actions
+        start = time.perf_counter()
+        assert self.infoset.is_legal_action(action)
         self.players[self._acting_player_position].set_action(action)
         self._env.step()
         self.infoset = self._game_infoset
+
+        obs_start = time.perf_counter()
         done = False
         reward = 0.0
         if self._game_over:
@@ -91,7 +107,10 @@ class Env:
             reward = self._get_reward()
             obs = None
         else:
-            obs = get_obs(self.infoset)
+            obs = get_obs(self.infoset, self.factored_obs, self.legal_mask)
+        if self.stage_timer is not None:
+            self.stage_timer.add('env_step', obs_start - start)
+            self.stage_timer.add('get_obs', time.perf_counter() - obs_start)
         return obs, reward, done, {}
 
     def _get_reward(self):
@@ -175,7 +194,7 @@ class DummyAgent(object):
         """
         Simply return the action that is set previously.
         """
-        assert self.action in infoset.legal_actions
+        assert infoset.is_legal_action(self.action)
         return self.action
 
     def set_action(self, action):
@@ -185,7 +204,12 @@ class DummyAgent(object):
         """
         self.action = action
 
-def get_obs(infoset):
+# The seats of the positions in the per-seat arrays of the infoset
+LANDLORD = Position2Seat['landlord']
+LANDLORD_UP = Position2Seat['landlord_up']
+LANDLORD_DOWN = Position2Seat['landlord_down']
+
+def get_obs(infoset, factored=False, legal_mask=False):
     """
     This function obtains observations with imperfect information
     from the infoset. It has three branches since we encode
@@ -200,7 +224,9 @@ def get_obs(infoset):
     `x_batch` is a batch of features (excluding the hisorical moves).
     It also encodes the action feature
 
-    `z_batch` is a batch of features with hisorical moves only.
+    `z_batch` is the features with hisorical moves only. They are
+    the same for all the legal actions, so it has a batch dim of 1
+    and the model shares the encoded history with every action.
 
     `legal_actions` is the legal moves
 
@@ -208,15 +234,33 @@ def get_obs(infoset):
     the action features). It does not have the batch dim.
 
     `z`: same as z_batch but not a batch.
+
+    With `factored=True`, `x_batch` only has the state features
+    (the same as `x_no_action`, with a batch dim of 1) and the
+    features of the legal actions are returned separately in
+    `action_batch`, so that the state is not repeated for every
+    action.
+
+    With `legal_mask=True`, the observation also has
+    `legal_action_ids`, the ids of the legal actions in the global
+    action table (see `douzero.env.action_space`) in the order of
+    `legal_actions`, and `legal_action_mask`, a boolean vector of
+    length `NUM_ACTIONS` that is True at these ids. Unlike the other
+    fields, the mask has the same shape for every decision, so the
+    masks of many games can be stacked into one tensor.
     """
     if infoset.player_position == 'landlord':
-        return _get_obs_landlord(infoset)
+        obs = _get_obs_landlord(infoset, factored)
     elif infoset.player_position == 'landlord_up':
-        return _get_obs_landlord_up(infoset)
+        obs = _get_obs_landlord_up(infoset, factored)
     elif infoset.player_position == 'landlord_down':
-        return _get_obs_landlord_down(infoset)
+        obs = _get_obs_landlord_down(infoset, factored)
     else:
         raise ValueError('')
+    if legal_mask:
+        obs['legal_action_ids'] = infoset.legal_action_ids
+        obs['legal_action_mask'] = _get_legal_action_mask(infoset.legal_action_ids)
+    return obs
 
 def _get_one_hot_array(num_left_cards, max_num_cards):
     """
@@ -232,51 +276,27 @@ def _cards2array(list_cards):
     A utility function that transforms the actions, i.e.,
     A list of integers into card matrix. Here we remove
     the six entries that are always zero and flatten the
-    the representations.
+    the representations. The encoding is looked up from
+    precomputed tables, see `douzero.env.encoding`.
     """
-    if len(list_cards) == 0:
-        return np.zeros(54, dtype=np.int8)
-
-    matrix = np.zeros([4, 13], dtype=np.int8)
-    jokers = np.zeros(2, dtype=np.int8)
-    counter = Counter(list_cards)
-    for card, num_times in counter.items():
-        if card < 20:
-            matrix[:, Card2Column[card]] = NumOnes2Array[num_times]
-        elif card == 20:
-            jokers[0] = 1
-        elif card == 30:
-            jokers[1] = 1
-    return np.concatenate((matrix.flatten('F'), jokers))
-
-def _action_seq_list2array(action_seq_list):
+    return cards2array(list_cards)
+
+def _get_other_handcards(infoset):
     """
-    A utility function to encode the historical moves.
-    We encode the historical 15 actions. If there is
-    no 15 actions, we pad the features with 0. Since
-    three moves is a round in DouDizhu, we concatenate
-    the representations for each consecutive three moves.
-    Finally, we obtain a 5x162 matrix, which will be fed
-    into LSTM for encoding.
+    The card matrix of the hand cards of the other two players,
+    from the rank counts of the hands kept by the engine.
     """
-    action_seq_array = np.zeros((len(action_seq_list), 54))
-    for row, list_cards in enumerate(action_seq_list):
-        action_seq_array[row, :] = _cards2array(list_cards)
-    action_seq_array = action_seq_array.reshape(5, 162)
-    return action_seq_array
+    hand_counts = infoset.hand_counts
+    return counts2array(hand_counts.sum(axis=0) - hand_counts[infoset.seat])
 
-def _process_action_seq(sequence, length=15):
+def _get_legal_action_mask(legal_action_ids):
     """
-    A utility function encoding historical moves. We
-    encode 15 moves. If there is no 15 moves, we pad
-    with zeros.
+    A boolean vector over the global action table that is
+    True at the ids of the legal actions.
     """
-    sequence = sequence[-length:].copy()
-    if len(sequence) < length:
-        empty_sequence = [[] for _ in range(length - len(sequence))]
-        empty_sequence.extend(sequence)
-        sequence = empty_sequence
-    return sequence
+    mask = np.zeros(NUM_ACTIONS, dtype=bool)
+    mask[legal_action_ids] = True
+    return mask
 
 def _get_one_hot_bomb(bomb_num):
     """
@@ -287,67 +307,32 @@ def _get_one_hot_bomb(bomb_num):
     one_hot[bomb_num] = 1
     return one_hot
 
-def _get_obs_landlord(infoset):
+def _get_obs_landlord(infoset, factored=False):
     """
     Obttain the landlord features. See Table 4 in
     https://arxiv.org/pdf/2106.06135.pdf
     """
-    num_legal_actions = len(infoset.legal_actions)
-    my_handcards = _cards2array(infoset.player_hand_cards)
-    my_handcards_batch = np.repeat(my_handcards[np.newaxis, :],
-                                   num_legal_actions, axis=0)
+    my_handcards = infoset.hand_arrays[infoset.seat]
 
-    other_handcards = _cards2array(infoset.other_hand_cards)
-    other_handcards_batch = np.repeat(other_handcards[np.newaxis, :],
-                                      num_legal_actions, axis=0)
+    other_handcards = _get_other_handcards(infoset)
 
-    last_action = _cards2array(infoset.last_move)
-    last_action_batch = np.repeat(last_action[np.newaxis, :],
-                                  num_legal_actions, axis=0)
+    last_action = ACTION_ARRAYS[action2id(infoset.last_move)]
 
-    my_action_batch = np.zeros(my_handcards_batch.shape)
-    for j, action in enumerate(infoset.legal_actions):
-        my_action_batch[j, :] = _cards2array(action)
+    my_action_batch = ACTION_ARRAYS[infoset.legal_action_ids]
 
     landlord_up_num_cards_left = _get_one_hot_array(
-        infoset.num_cards_left_dict['landlord_up'], 17)
-    landlord_up_num_cards_left_batch = np.repeat(
-        landlord_up_num_cards_left[np.newaxis, :],
-        num_legal_actions, axis=0)
+        len(infoset.hands[LANDLORD_UP]), 17)
 
     landlord_down_num_cards_left = _get_one_hot_array(
-        infoset.num_cards_left_dict['landlord_down'], 17)
-    landlord_down_num_cards_left_batch = np.repeat(
-        landlord_down_num_cards_left[np.newaxis, :],
-        num_legal_actions, axis=0)
-
-    landlord_up_played_cards = _cards2array(
-        infoset.played_cards['landlord_up'])
-    landlord_up_played_cards_batch = np.repeat(
-        landlord_up_played_cards[np.newaxis, :],
-        num_legal_actions, axis=0)
-
-    landlord_down_played_cards = _cards2array(
-        infoset.played_cards['landlord_down'])
-    landlord_down_played_cards_batch = np.repeat(
-        landlord_down_played_cards[np.newaxis, :],
-        num_legal_actions, axis=0)
+        len(infoset.hands[LANDLORD_DOWN]), 17)
+
+    landlord_up_played_cards = infoset.played_arrays[LANDLORD_UP]
+
+    landlord_down_played_cards = infoset.played_arrays[LANDLORD_DOWN]
 
     bomb_num = _get_one_hot_bomb(
         infoset.bomb_num)
-    bomb_num_batch = np.repeat(
-        bomb_num[np.newaxis, :],
-        num_legal_actions, axis=0)
-
-    x_batch = np.hstack((my_handcards_batch,
-                         other_handcards_batch,
-                         last_action_batch,
-                         landlord_up_played_cards_batch,
-                         landlord_down_played_cards_batch,
-                         landlord_up_num_cards_left_batch,
-                         landlord_down_num_cards_left_batch,
-                         bomb_num_batch,
-                         my_action_batch))
+
     x_no_action = np.hstack((my_handcards,
                              other_handcards,
                              last_action,
@@ -356,94 +341,38 @@ def _get_obs_landlord(infoset):
                              landlord_up_num_cards_left,
                              landlord_down_num_cards_left,
                              bomb_num))
-    z = _action_seq_list2array(_process_action_seq(
-        infoset.card_play_action_seq))
-    z_batch = np.repeat(
-        z[np.newaxis, :, :],
-        num_legal_actions, axis=0)
-    obs = {
-            'position': 'landlord',
-            'x_batch': x_batch.astype(np.float32),
-            'z_batch': z_batch.astype(np.float32),
-            'legal_actions': infoset.legal_actions,
-            'x_no_action': x_no_action.astype(np.int8),
-            'z': z.astype(np.int8),
-          }
-    return obs
+    z = infoset.action_seq_array
+    return _make_obs('landlord', infoset, x_no_action,
+                     my_action_batch, z, factored)
 
-def _get_obs_landlord_up(infoset):
+def _get_obs_landlord_up(infoset, factored=False):
     """
     Obttain the landlord_up features. See Table 5 in
     https://arxiv.org/pdf/2106.06135.pdf
     """
-    num_legal_actions = len(infoset.legal_actions)
-    my_handcards = _cards2array(infoset.player_hand_cards)
-    my_handcards_batch = np.repeat(my_handcards[np.newaxis, :],
-                                   num_legal_actions, axis=0)
-
-    other_handcards = _cards2array(infoset.other_hand_cards)
-    other_handcards_batch = np.repeat(other_handcards[np.newaxis, :],
-                                      num_legal_actions, axis=0)
-
-    last_action = _cards2array(infoset.last_move)
-    last_action_batch = np.repeat(last_action[np.newaxis, :],
-                                  num_legal_actions, axis=0)
-
-    my_action_batch = np.zeros(my_handcards_batch.shape)
-    for j, action in enumerate(infoset.legal_actions):
-        my_action_batch[j, :] = _cards2array(action)
-
-    last_landlord_action = _cards2array(
-        infoset.last_move_dict['landlord'])
-    last_landlord_action_batch = np.repeat(
-        last_landlord_action[np.newaxis, :],
-        num_legal_actions, axis=0)
+    my_handcards = infoset.hand_arrays[infoset.seat]
+
+    other_handcards = _get_other_handcards(infoset)
+
+    last_action = ACTION_ARRAYS[action2id(infoset.last_move)]
+
+    my_action_batch = ACTION_ARRAYS[infoset.legal_action_ids]
+
+    last_landlord_action = infoset.last_move_arrays[LANDLORD]
     landlord_num_cards_left = _get_one_hot_array(
-        infoset.num_cards_left_dict['landlord'], 20)
-    landlord_num_cards_left_batch = np.repeat(
-        landlord_num_cards_left[np.newaxis, :],
-        num_legal_actions, axis=0)
-
-    landlord_played_cards = _cards2array(
-        infoset.played_cards['landlord'])
-    landlord_played_cards_batch = np.repeat(
-        landlord_played_cards[np.newaxis, :],
-        num_legal_actions, axis=0)
-
-    last_teammate_action = _cards2array(
-        infoset.last_move_dict['landlord_down'])
-    last_teammate_action_batch = np.repeat(
-        last_teammate_action[np.newaxis, :],
-        num_legal_actions, axis=0)
+        len(infoset.hands[LANDLORD]), 20)
+
+    landlord_played_cards = infoset.played_arrays[LANDLORD]
+
+    last_teammate_action = infoset.last_move_arrays[LANDLORD_DOWN]
     teammate_num_cards_left = _get_one_hot_array(
-        infoset.num_cards_left_dict['landlord_down'], 17)
-    teammate_num_cards_left_batch = np.repeat(
-        teammate_num_cards_left[np.newaxis, :],
-        num_legal_actions, axis=0)
+        len(infoset.hands[LANDLORD_DOWN]), 17)
 
-    teammate_played_cards = _cards2array(
-        infoset.played_cards['landlord_down'])
-    teammate_played_cards_batch = np.repeat(
-        teammate_played_cards[np.newaxis, :],
-        num_legal_actions, axis=0)
+    teammate_played_cards = infoset.played_arrays[LANDLORD_DOWN]
 
     bomb_num = _get_one_hot_bomb(
         infoset.bomb_num)
-    bomb_num_batch = np.repeat(
-        bomb_num[np.newaxis, :],
-        num_legal_actions, axis=0)
-
-    x_batch = np.hstack((my_handcards_batch,
-                         other_handcards_batch,
-                         landlord_played_cards_batch,
-                         teammate_played_cards_batch,
-                         last_action_batch,
-                         last_landlord_action_batch,
-                         last_teammate_action_batch,
-                         landlord_num_cards_left_batch,
-                         teammate_num_cards_left_batch,
-                         bomb_num_batch,
-                         my_action_batch))
+
     x_no_action = np.hstack((my_handcards,
                              other_handcards,
                              landlord_played_cards,
@@ -454,100 +383,38 @@ def _get_obs_landlord_up(infoset):
                              landlord_num_cards_left,
                              teammate_num_cards_left,
                              bomb_num))
-    z = _action_seq_list2array(_process_action_seq(
-        infoset.card_play_action_seq))
-    z_batch = np.repeat(
-        z[np.newaxis, :, :],
-        num_legal_actions, axis=0)
-    obs = {
-            'position': 'landlord_up',
-            'x_batch': x_batch.astype(np.float32),
-            'z_batch': z_batch.astype(np.float32),
-            'legal_actions': infoset.legal_actions,
-            'x_no_action': x_no_action.astype(np.int8),
-            'z': z.astype(np.int8),
-          }
-    return obs
+    z = infoset.action_seq_array
+    return _make_obs('landlord_up', infoset, x_no_action,
+                     my_action_batch, z, factored)
 
-def _get_obs_landlord_down(infoset):
+def _get_obs_landlord_down(infoset, factored=False):
     """
     Obttain the landlord_down features. See Table 5 in
     https://arxiv.org/pdf/2106.06135.pdf
     """
-    num_legal_actions = len(infoset.legal_actions)
-    my_handcards = _cards2array(infoset.player_hand_cards)
-    my_handcards_batch = np.repeat(my_handcards[np.newaxis, :],
-                                   num_legal_actions, axis=0)
-
-    other_handcards = _cards2array(infoset.other_hand_cards)
-    other_handcards_batch = np.repeat(other_handcards[np.newaxis, :],
-                                      num_legal_actions, axis=0)
-
-    last_action = _cards2array(infoset.last_move)
-    last_action_batch = np.repeat(last_action[np.newaxis, :],
-                                  num_legal_actions, axis=0)
-
-    my_action_batch = np.zeros(my_handcards_batch.shape)
-    for j, action in enumerate(infoset.legal_actions):
-        my_action_batch[j, :] = _cards2array(action)
-
-    last_landlord_action = _cards2array(
-        infoset.last_move_dict['landlord'])
-    last_landlord_action_batch = np.repeat(
-        last_landlord_action[np.newaxis, :],
-        num_legal_actions, axis=0)
+    my_handcards = infoset.hand_arrays[infoset.seat]
+
+    other_handcards = _get_other_handcards(infoset)
+
+    last_action = ACTION_ARRAYS[action2id(infoset.last_move)]
+
+    my_action_batch = ACTION_ARRAYS[infoset.legal_action_ids]
+
+    last_landlord_action = infoset.last_move_arrays[LANDLORD]
     landlord_num_cards_left = _get_one_hot_array(
-        infoset.num_cards_left_dict['landlord'], 20)
-    landlord_num_cards_left_batch = np.repeat(
-        landlord_num_cards_left[np.newaxis, :],
-        num_legal_actions, axis=0)
-
-    landlord_played_cards = _cards2array(
-        infoset.played_cards['landlord'])
-    landlord_played_cards_batch = np.repeat(
-        landlord_played_cards[np.newaxis, :],
-        num_legal_actions, axis=0)
-
-    last_teammate_action = _cards2array(
-        infoset.last_move_dict['landlord_up'])
-    last_teammate_action_batch = np.repeat(
-        last_teammate_action[np.newaxis, :],
-        num_legal_actions, axis=0)
+        len(infoset.hands[LANDLORD]), 20)
+
+    landlord_played_cards = infoset.played_arrays[LANDLORD]
+
+    last_teammate_action = infoset.last_move_arrays[LANDLORD_UP]
     teammate_num_cards_left = _get_one_hot_array(
-        infoset.num_cards_left_dict['landlord_up'], 17)
-    teammate_num_cards_left_batch = np.repeat(
-        teammate_num_cards_left[np.newaxis, :],
-        num_legal_actions, axis=0)
-
-    teammate_played_cards = _cards2array(
-        infoset.played_cards['landlord_up'])
-    teammate_played_cards_batch = np.repeat(
-        teammate_played_cards[np.newaxis, :],
-        num_legal_actions, axis=0)
-
-    landlord_played_cards = _cards2array(
-        infoset.played_cards['landlord'])
-    landlord_played_cards_batch = np.repeat(
-        landlord_played_cards[np.newaxis, :],
-        num_legal_actions, axis=0)
+        len(infoset.hands[LANDLORD_UP]), 17)
+
+    teammate_played_cards = infoset.played_arrays[LANDLORD_UP]
 
     bomb_num = _get_one_hot_bomb(
         infoset.bomb_num)
-    bomb_num_batch = np.repeat(
-        bomb_num[np.newaxis, :],
-        num_legal_actions, axis=0)
-
-    x_batch = np.hstack((my_handcards_batch,
-                         other_handcards_batch,
-                         landlord_played_cards_batch,
-                         teammate_played_cards_batch,
-                         last_action_batch,
-                         last_landlord_action_batch,
-                         last_teammate_action_batch,
-                         landlord_num_cards_left_batch,
-                         teammate_num_cards_left_batch,
-                         bomb_num_batch,
-                         my_action_batch))
+
     x_no_action = np.hstack((my_handcards,
                              other_handcards,
                              landlord_played_cards,
@@ -558,17 +425,34 @@ def _get_obs_landlord_down(infoset):
                              landlord_num_cards_left,
                              teammate_num_cards_left,
                              bomb_num))
-    z = _action_seq_list2array(_process_action_seq(
-        infoset.card_play_action_seq))
-    z_batch = np.repeat(
-        z[np.newaxis, :, :],
-        num_legal_actions, axis=0)
+    z = infoset.action_seq_array
+    return _make_obs('landlord_down', infoset, x_no_action,
+                     my_action_batch, z, factored)
+
+def _make_obs(position, infoset, x_no_action, my_action_batch, z, factored):
+    """
+    Assemble the observation dict from the state features, which
+    are shared by all the legal actions, and the action features.
+    In the full mode `x_batch` has one row per legal action with
+    the action features in the last 54 columns. In the factored
+    mode `x_batch` is the state features only (batch dim of 1) and
+    `action_batch` holds the action features, which is what the
+    model expects when it is called with `actions`.
+    """
     obs = {
-            'position': 'landlord_down',
-            'x_batch': x_batch.astype(np.float32),
-            'z_batch': z_batch.astype(np.float32),
+            'position': position,
+            'z_batch': z[np.newaxis, :, :].astype(np.float32),
             'legal_actions': infoset.legal_actions,
             'x_no_action': x_no_action.astype(np.int8),
             'z': z.astype(np.int8),
           }
+    if factored:
+        obs['x_batch'] = x_no_action[np.newaxis, :].astype(np.float32)
+        obs['action_batch'] = my_action_batch.astype(np.float32)
+    else:
+        num_legal_actions, state_dim = my_action_batch.shape[0], x_no_action.shape[0]
+        x_batch = np.empty((num_legal_actions, state_dim + 54), dtype=np.float32)
+        x_batch[:, :state_dim] = x_no_action
+        x_batch[:, state_dim:] = my_action_batch
+        obs['x_batch'] = x_batch
     return obs
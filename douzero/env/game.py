@@ -1,6 +1,13 @@
-from copy import deepcopy
+import functools
+import time
+
+import numpy as np
 from . import move_detector as md, move_selector as ms
 from .move_generator import MovesGener
+from .count_move_generator import gen_legal_moves
+from .action_space import ACTIONS, ACTION_ARRAYS, ACTION_COUNTS, ACTION_TYPES, \
+    action2id, id2action, actions2ids
+from .encoding import cards2counts, counts2array
 
 EnvCard2RealCard = {3: '3', 4: '4', 5: '5', 6: '6', 7: '7',
                     8: '8', 9: '9', 10: '10', 11: 'J', 12: 'Q',
@@ -10,35 +17,172 @@ RealCard2EnvCard = {'3': 3, '4': 4, '5': 5, '6': 6, '7': 7,
                     '8': 8, '9': 9, '10': 10, 'J': 11, 'Q': 12,
                     'K': 13, 'A': 14, '2': 17, 'X': 20, 'D': 30}
 
+# The positions in the order of the per-seat state of `GameEnv`
+Positions = ['landlord', 'landlord_up', 'landlord_down']
+Position2Seat = {position: seat for seat, position in enumerate(Positions)}
+
+# The number of most recent moves in the history feature
+NUM_HISTORY_MOVES = 15
+
 bombs = [[3, 3, 3, 3], [4, 4, 4, 4], [5, 5, 5, 5], [6, 6, 6, 6],
          [7, 7, 7, 7], [8, 8, 8, 8], [9, 9, 9, 9], [10, 10, 10, 10],
          [11, 11, 11, 11], [12, 12, 12, 12], [13, 13, 13, 13], [14, 14, 14, 14],
          [17, 17, 17, 17], [20, 30]]
 
-class GameEnv(object):
+def _gen_legal_card_play_actions(hand_cards, rival_move):
+    """
+    Generate the moves of a hand that can follow the rival move.
+    This is the uncached generator behind `_get_legal_action_ids`.
+    """
+    mg = MovesGener(hand_cards)
 
-    def __init__(self, players):
+    rival_type = md.get_move_type(rival_move)
+    rival_move_type = rival_type['type']
+    rival_move_len = rival_type.get('len', 1)
+    moves = list()
 
-        self.card_play_action_seq = []
+    if rival_move_type == md.TYPE_0_PASS:
+        moves = mg.gen_moves()
 
-        self.three_landlord_cards = None
-        self.game_over = False
+    elif rival_move_type == md.TYPE_1_SINGLE:
+        all_moves = mg.gen_type_1_single()
+        moves = ms.filter_type_1_single(all_moves, rival_move)
 
-        self.acting_player_position = None
-        self.player_utility_dict = None
+    elif rival_move_type == md.TYPE_2_PAIR:
+        all_moves = mg.gen_type_2_pair()
+        moves = ms.filter_type_2_pair(all_moves, rival_move)
 
-        self.players = players
+    elif rival_move_type == md.TYPE_3_TRIPLE:
+        all_moves = mg.gen_type_3_triple()
+        moves = ms.filter_type_3_triple(all_moves, rival_move)
+
+    elif rival_move_type == md.TYPE_4_BOMB:
+        all_moves = mg.gen_type_4_bomb() + mg.gen_type_5_king_bomb()
+        moves = ms.filter_type_4_bomb(all_moves, rival_move)
+
+    elif rival_move_type == md.TYPE_5_KING_BOMB:
+        moves = []
+
+    elif rival_move_type == md.TYPE_6_3_1:
+        all_moves = mg.gen_type_6_3_1()
+        moves = ms.filter_type_6_3_1(all_moves, rival_move)
+
+    elif rival_move_type == md.TYPE_7_3_2:
+        all_moves = mg.gen_type_7_3_2()
+        moves = ms.filter_type_7_3_2(all_moves, rival_move)
+
+    elif rival_move_type == md.TYPE_8_SERIAL_SINGLE:
+        all_moves = mg.gen_type_8_serial_single(repeat_num=rival_move_len)
+        moves = ms.filter_type_8_serial_single(all_moves, rival_move)
+
+    elif rival_move_type == md.TYPE_9_SERIAL_PAIR:
+        all_moves = mg.gen_type_9_serial_pair(repeat_num=rival_move_len)
+        moves = ms.filter_type_9_serial_pair(all_moves, rival_move)
+
+    elif rival_move_type == md.TYPE_10_SERIAL_TRIPLE:
+        all_moves = mg.gen_type_10_serial_triple(repeat_num=rival_move_len)
+        moves = ms.filter_type_10_serial_triple(all_moves, rival_move)
+
+    elif rival_move_type == md.TYPE_11_SERIAL_3_1:
+        all_moves = mg.gen_type_11_serial_3_1(repeat_num=rival_move_len)
+        moves = ms.filter_type_11_serial_3_1(all_moves, rival_move)
 
-        self.last_move_dict = {'landlord': [],
-                               'landlord_up': [],
-                               'landlord_down': []}
+    elif rival_move_type == md.TYPE_12_SERIAL_3_2:
+        all_moves = mg.gen_type_12_serial_3_2(repeat_num=rival_move_len)
+        moves = ms.filter_type_12_serial_3_2(all_moves, rival_move)
 
-        self.played_cards = {'landlord': [],
-                             'landlord_up': [],
-                             'landlord_down': []}
+    elif rival_move_type == md.TYPE_13_4_2:
+        all_moves = mg.gen_type_13_4_2()
+        moves = ms.filter_type_13_4_2(all_moves, rival_move)
 
-        self.last_move = []
-        self.last_two_moves = []
+    elif rival_move_type == md.TYPE_14_4_22:
+        all_moves = mg.gen_type_14_4_22()
+        moves = ms.filter_type_14_4_22(all_moves, rival_move)
+
+    if rival_move_type not in [md.TYPE_0_PASS,
+                               md.TYPE_4_BOMB, md.TYPE_5_KING_BOMB]:
+        moves = moves + mg.gen_type_4_bomb() + mg.gen_type_5_king_bomb()
+
+    if len(rival_move) != 0:  # rival_move is not 'pass'
+        moves = moves + [[]]
+
+    for m in moves:
+        m.sort()
+
+    return moves
+
+# The move generators that can back `get_legal_card_play_actions`.
+# They return the same moves; `counts` works on rank count vectors
+# and only visits the ranks that can beat the rival move
+MOVE_GENERATORS = {'legacy': _gen_legal_card_play_actions,
+                   'counts': gen_legal_moves}
+_move_generator = MOVE_GENERATORS['counts']
+
+def set_move_generator(name):
+    """
+    Select the move generator by its name in `MOVE_GENERATORS`.
+    The legal actions cache is emptied since it holds the moves of
+    the previous generator.
+    """
+    global _move_generator
+    if name not in MOVE_GENERATORS:
+        raise ValueError('Unknown move generator: {}'.format(name))
+    _move_generator = MOVE_GENERATORS[name]
+    legal_actions_cache_clear()
+
+# The number of (hand, rival move) pairs whose legal actions are kept
+LEGAL_ACTIONS_CACHE_SIZE = 2 ** 16
+
+@functools.lru_cache(maxsize=LEGAL_ACTIONS_CACHE_SIZE)
+def _get_legal_action_ids(hand_cards, rival_move_id):
+    """
+    The legal actions of a hand (a sorted tuple of cards) against
+    the move to beat (its action id) as a read-only array of ids.
+    The same pairs come back again and again in self-play, so the
+    results are kept in a bounded LRU cache.
+    """
+    moves = _move_generator(list(hand_cards), id2action(rival_move_id))
+    legal_action_ids = actions2ids(moves)
+    legal_action_ids.setflags(write=False)
+    return legal_action_ids
+
+def legal_actions_cache_info():
+    """
+    Hits, misses and size of the legal actions cache.
+    """
+    return _get_legal_action_ids.cache_info()
+
+def legal_actions_cache_clear():
+    """
+    Empty the legal actions cache and reset its counters.
+    """
+    _get_legal_action_ids.cache_clear()
+
+class GameEnv(object):
+    """
+    The game engine. The state of the three players is kept per
+    seat, i.e., in lists and arrays indexed by the position of the
+    player in `Positions`: the hand cards and the played cards as
+    sorted tuples, the number of cards of each rank in them as
+    (3, 15) arrays, and their 54-dim card matrices, as well as the
+    one of the last move of each player, as (3, 54) int8 arrays.
+    They are all updated in `step`, only for the acting player.
+    """
+    __slots__ = ('players', 'card_play_action_seq', 'three_landlord_cards',
+                 'game_over', 'acting_player_position', 'player_utility_dict',
+                 'hand_cards', 'hand_counts', 'hand_arrays',
+                 'played_cards', 'played_counts', 'played_arrays',
+                 'last_moves', 'last_move_arrays', 'action_seq_buffer', 'action_seq_start',
+                 'num_wins', 'num_scores', 'bomb_num', 'last_pid',
+                 'winner', 'game_infoset', 'stage_timer')
+
+    def __init__(self, players):
+
+        self.players = players
+
+        # An optional timer (see `douzero.dmc.timing`) that gets the
+        # time of the legal move generation as `move_gen`
+        self.stage_timer = None
 
         self.num_wins = {'landlord': 0,
                          'farmer': 0}
@@ -46,28 +190,19 @@ class GameEnv(object):
         self.num_scores = {'landlord': 0,
                            'farmer': 0}
 
-        self.info_sets = {'landlord': InfoSet('landlord'),
-                         'landlord_up': InfoSet('landlord_up'),
-                         'landlord_down': InfoSet('landlord_down')}
-
-        self.bomb_num = 0
-        self.last_pid = 'landlord'
+        self.reset()
 
     def card_play_init(self, card_play_data):
-        self.info_sets['landlord'].player_hand_cards = \
-            card_play_data['landlord']
-        self.info_sets['landlord_up'].player_hand_cards = \
-            card_play_data['landlord_up']
-        self.info_sets['landlord_down'].player_hand_cards = \
-            card_play_data['landlord_down']
-        self.three_landlord_cards = card_play_data['three_landlord_cards']
+        for seat, position in enumerate(Positions):
+            self.hand_cards[seat] = tuple(sorted(card_play_data[position]))
+            self.hand_counts[seat] = cards2counts(self.hand_cards[seat])
+        counts2array(self.hand_counts, out=self.hand_arrays)
+        self.three_landlord_cards = tuple(card_play_data['three_landlord_cards'])
         self.get_acting_player_position()
         self.game_infoset = self.get_infoset()
 
     def game_done(self):
-        if len(self.info_sets['landlord'].player_hand_cards) == 0 or \
-                len(self.info_sets['landlord_up'].player_hand_cards) == 0 or \
-                len(self.info_sets['landlord_down'].player_hand_cards) == 0:
+        if any(len(hand_cards) == 0 for hand_cards in self.hand_cards):
             # if one of the three players discards his hand,
             # then game is over.
             self.compute_player_utility()
@@ -78,7 +213,7 @@ class GameEnv(object):
 
     def compute_player_utility(self):
 
-        if len(self.info_sets['landlord'].player_hand_cards) == 0:
+        if len(self.hand_cards[Position2Seat['landlord']]) == 0:
             self.player_utility_dict = {'landlord': 2,
                                         'farmer': -1}
         else:
@@ -104,32 +239,42 @@ class GameEnv(object):
     def step(self):
         action = self.players[self.acting_player_position].act(
             self.game_infoset)
-        legal_actions = self.game_infoset.legal_actions
-        assert action in legal_actions
+        assert self.game_infoset.is_legal_action(action)
+        action_id = action2id(action)
+        # The moves are kept as tuples and never changed, so that
+        # the infosets can share them, see `get_infoset`
+        action = ACTIONS[action_id]
+        seat = Position2Seat[self.acting_player_position]
 
         if len(action) > 0:
             self.last_pid = self.acting_player_position
 
-        if action in bombs:
+        if ACTION_TYPES[action_id] in (md.TYPE_4_BOMB, md.TYPE_5_KING_BOMB):
             self.bomb_num += 1
 
-        self.last_move_dict[
-            self.acting_player_position] = action.copy()
+        self.last_moves[seat] = action
+        self.last_move_arrays[seat] = ACTION_ARRAYS[action_id]
 
         self.card_play_action_seq.append(action)
-        self.update_acting_player_hand_cards(action)
+        self.update_action_seq_buffer(action_id)
+        self.update_acting_player_hand_cards(action, action_id)
 
-        self.played_cards[self.acting_player_position] += action
+        if len(action) > 0:
+            self.played_cards[seat] = self.played_cards[seat] + action
+            self.played_counts[seat] += ACTION_COUNTS[action_id]
+            counts2array(self.played_counts[seat], out=self.played_arrays[seat])
 
         if self.acting_player_position == 'landlord' and \
                 len(action) > 0 and \
                 len(self.three_landlord_cards) > 0:
+            three_landlord_cards = list(self.three_landlord_cards)
             for card in action:
-                if len(self.three_landlord_cards) > 0:
-                    if card in self.three_landlord_cards:
-                        self.three_landlord_cards.remove(card)
+                if len(three_landlord_cards) > 0:
+                    if card in three_landlord_cards:
+                        three_landlord_cards.remove(card)
                 else:
                     break
+            self.three_landlord_cards = tuple(three_landlord_cards)
 
         self.game_done()
         if not self.game_over:
@@ -140,19 +285,42 @@ class GameEnv(object):
         last_move = []
         if len(self.card_play_action_seq) != 0:
             if len(self.card_play_action_seq[-1]) == 0:
-                last_move = self.card_play_action_seq[-2]
+                last_move = list(self.card_play_action_seq[-2])
             else:
-                last_move = self.card_play_action_seq[-1]
+                last_move = list(self.card_play_action_seq[-1])
 
         return last_move
 
     def get_last_two_moves(self):
         last_two_moves = [[], []]
         for card in self.card_play_action_seq[-2:]:
-            last_two_moves.insert(0, card)
+            last_two_moves.insert(0, list(card))
             last_two_moves = last_two_moves[:2]
         return last_two_moves
 
+    def update_action_seq_buffer(self, action_id):
+        # Every move is written twice, NUM_HISTORY_MOVES rows apart,
+        # so that the last moves are always the contiguous rows
+        # [action_seq_start, action_seq_start + NUM_HISTORY_MOVES)
+        start = self.action_seq_start
+        self.action_seq_buffer[start] = ACTION_ARRAYS[action_id]
+        self.action_seq_buffer[start + NUM_HISTORY_MOVES] = ACTION_ARRAYS[action_id]
+        self.action_seq_start = (start + 1) % NUM_HISTORY_MOVES
+
+    def get_action_seq_array(self):
+        """
+        The encoding of the historical moves. We encode the
+        historical 15 actions, oldest first. If there is no 15
+        actions, the features are padded with 0 in the front.
+        Since three moves is a round in DouDizhu, we concatenate
+        the representations for each consecutive three moves.
+        Finally, we obtain a 5x162 matrix, which will be fed
+        into LSTM for encoding. This is a view of the ring buffer
+        that `step` updates, so it changes with the next move.
+        """
+        start = self.action_seq_start
+        return self.action_seq_buffer[start:start + NUM_HISTORY_MOVES].reshape(5, 162)
+
     def get_acting_player_position(self):
         if self.acting_player_position is None:
             self.acting_player_position = 'landlord'
@@ -169,16 +337,27 @@ class GameEnv(object):
 
         return self.acting_player_position
 
-    def update_acting_player_hand_cards(self, action):
-        if action != []:
+    def update_acting_player_hand_cards(self, action, action_id):
+        if len(action) > 0:
+            seat = Position2Seat[self.acting_player_position]
+            hand_cards = list(self.hand_cards[seat])
             for card in action:
-                self.info_sets[
-                    self.acting_player_position].player_hand_cards.remove(card)
-            self.info_sets[self.acting_player_position].player_hand_cards.sort()
+                hand_cards.remove(card)
+            self.hand_cards[seat] = tuple(hand_cards)
+            self.hand_counts[seat] -= ACTION_COUNTS[action_id]
+            counts2array(self.hand_counts[seat], out=self.hand_arrays[seat])
 
     def get_legal_card_play_actions(self):
-        mg = MovesGener(
-            self.info_sets[self.acting_player_position].player_hand_cards)
+        legal_action_ids = self.get_legal_card_play_action_ids()
+        return [id2action(action_id) for action_id in legal_action_ids]
+
+    def get_legal_card_play_action_ids(self):
+        """
+        The ids of the legal actions of the acting player. The result
+        only depends on the hand and on the move to beat, so it is
+        memoized across steps and games, see `_get_legal_action_ids`.
+        """
+        hand_cards = self.hand_cards[Position2Seat[self.acting_player_position]]
 
         action_sequence = self.card_play_action_seq
 
@@ -189,80 +368,7 @@ class GameEnv(object):
             else:
                 rival_move = action_sequence[-1]
 
-        rival_type = md.get_move_type(rival_move)
-        rival_move_type = rival_type['type']
-        rival_move_len = rival_type.get('len', 1)
-        moves = list()
-
-        if rival_move_type == md.TYPE_0_PASS:
-            moves = mg.gen_moves()
-
-        elif rival_move_type == md.TYPE_1_SINGLE:
-            all_moves = mg.gen_type_1_single()
-            moves = ms.filter_type_1_single(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_2_PAIR:
-            all_moves = mg.gen_type_2_pair()
-            moves = ms.filter_type_2_pair(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_3_TRIPLE:
-            all_moves = mg.gen_type_3_triple()
-            moves = ms.filter_type_3_triple(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_4_BOMB:
-            all_moves = mg.gen_type_4_bomb() + mg.gen_type_5_king_bomb()
-            moves = ms.filter_type_4_bomb(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_5_KING_BOMB:
-            moves = []
-
-        elif rival_move_type == md.TYPE_6_3_1:
-            all_moves = mg.gen_type_6_3_1()
-            moves = ms.filter_type_6_3_1(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_7_3_2:
-            all_moves = mg.gen_type_7_3_2()
-            moves = ms.filter_type_7_3_2(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_8_SERIAL_SINGLE:
-            all_moves = mg.gen_type_8_serial_single(repeat_num=rival_move_len)
-            moves = ms.filter_type_8_serial_single(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_9_SERIAL_PAIR:
-            all_moves = mg.gen_type_9_serial_pair(repeat_num=rival_move_len)
-            moves = ms.filter_type_9_serial_pair(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_10_SERIAL_TRIPLE:
-            all_moves = mg.gen_type_10_serial_triple(repeat_num=rival_move_len)
-            moves = ms.filter_type_10_serial_triple(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_11_SERIAL_3_1:
-            all_moves = mg.gen_type_11_serial_3_1(repeat_num=rival_move_len)
-            moves = ms.filter_type_11_serial_3_1(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_12_SERIAL_3_2:
-            all_moves = mg.gen_type_12_serial_3_2(repeat_num=rival_move_len)
-            moves = ms.filter_type_12_serial_3_2(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_13_4_2:
-            all_moves = mg.gen_type_13_4_2()
-            moves = ms.filter_type_13_4_2(all_moves, rival_move)
-
-        elif rival_move_type == md.TYPE_14_4_22:
-            all_moves = mg.gen_type_14_4_22()
-            moves = ms.filter_type_14_4_22(all_moves, rival_move)
-
-        if rival_move_type not in [md.TYPE_0_PASS,
-                                   md.TYPE_4_BOMB, md.TYPE_5_KING_BOMB]:
-            moves = moves + mg.gen_type_4_bomb() + mg.gen_type_5_king_bomb()
-
-        if len(rival_move) != 0:  # rival_move is not 'pass'
-            moves = moves + [[]]
-
-        for m in moves:
-            m.sort()
-
-        return moves
+        return _get_legal_action_ids(hand_cards, action2id(rival_move))
 
     def reset(self):
         self.card_play_action_seq = []
@@ -273,68 +379,66 @@ class GameEnv(object):
         self.acting_player_position = None
         self.player_utility_dict = None
 
-        self.last_move_dict = {'landlord': [],
-                               'landlord_up': [],
-                               'landlord_down': []}
+        self.hand_cards = [(), (), ()]
+        self.hand_counts = np.zeros((3, 15), dtype=np.int8)
+        self.hand_arrays = np.zeros((3, 54), dtype=np.int8)
 
-        self.played_cards = {'landlord': [],
-                             'landlord_up': [],
-                             'landlord_down': []}
+        self.played_cards = [(), (), ()]
+        self.played_counts = np.zeros((3, 15), dtype=np.int8)
+        self.played_arrays = np.zeros((3, 54), dtype=np.int8)
 
-        self.last_move = []
-        self.last_two_moves = []
+        self.last_moves = [(), (), ()]
+        self.last_move_arrays = np.zeros((3, 54), dtype=np.int8)
 
-        self.info_sets = {'landlord': InfoSet('landlord'),
-                         'landlord_up': InfoSet('landlord_up'),
-                         'landlord_down': InfoSet('landlord_down')}
+        self.action_seq_buffer = np.zeros((2 * NUM_HISTORY_MOVES, 54), dtype=np.int8)
+        self.action_seq_start = 0
 
         self.bomb_num = 0
         self.last_pid = 'landlord'
+        self.winner = None
+        self.game_infoset = None
 
     def get_infoset(self):
-        self.info_sets[
-            self.acting_player_position].last_pid = self.last_pid
-
-        self.info_sets[
-            self.acting_player_position].legal_actions = \
-            self.get_legal_card_play_actions()
-
-        self.info_sets[
-            self.acting_player_position].bomb_num = self.bomb_num
-
-        self.info_sets[
-            self.acting_player_position].last_move = self.get_last_move()
-
-        self.info_sets[
-            self.acting_player_position].last_two_moves = self.get_last_two_moves()
-
-        self.info_sets[
-            self.acting_player_position].last_move_dict = self.last_move_dict
+        """
+        A new infoset of the acting player. The hands, the played
+        cards and the moves are tuples that the engine replaces
+        instead of changing, so the infoset can share them; only the
+        count arrays are copied. The fields that agents read as dicts
+        or lists, e.g., `all_handcards` or `legal_actions`, are built
+        from them when they are first read, see `InfoSet`.
+        """
+        position = self.acting_player_position
+        infoset = InfoSet(position)
+
+        infoset.hands = tuple(self.hand_cards)
+        infoset.hand_counts = self.hand_counts.copy()
+        infoset.hand_arrays = self.hand_arrays.copy()
+        infoset.played = tuple(self.played_cards)
+        infoset.played_counts = self.played_counts.copy()
+        infoset.played_arrays = self.played_arrays.copy()
+        infoset.last_moves = tuple(self.last_moves)
+        infoset.last_move_arrays = self.last_move_arrays.copy()
+
+        infoset.last_pid = self.last_pid
+
+        if self.stage_timer is None:
+            infoset.legal_action_ids = self.get_legal_card_play_action_ids()
+        else:
+            start = time.perf_counter()
+            infoset.legal_action_ids = self.get_legal_card_play_action_ids()
+            self.stage_timer.add('move_gen', time.perf_counter() - start)
 
-        self.info_sets[self.acting_player_position].num_cards_left_dict = \
-            {pos: len(self.info_sets[pos].player_hand_cards)
-             for pos in ['landlord', 'landlord_up', 'landlord_down']}
+        infoset.bomb_num = self.bomb_num
 
-        self.info_sets[self.acting_player_position].other_hand_cards = []
-        for pos in ['landlord', 'landlord_up', 'landlord_down']:
-            if pos != self.acting_player_position:
-                self.info_sets[
-                    self.acting_player_position].other_hand_cards += \
-                    self.info_sets[pos].player_hand_cards
+        infoset.last_move = self.get_last_move()
 
-        self.info_sets[self.acting_player_position].played_cards = \
-            self.played_cards
-        self.info_sets[self.acting_player_position].three_landlord_cards = \
-            self.three_landlord_cards
-        self.info_sets[self.acting_player_position].card_play_action_seq = \
-            self.card_play_action_seq
+        infoset.last_two_moves = self.get_last_two_moves()
 
-        self.info_sets[
-            self.acting_player_position].all_handcards = \
-            {pos: self.info_sets[pos].player_hand_cards
-             for pos in ['landlord', 'landlord_up', 'landlord_down']}
+        infoset.three_landlord_cards = self.three_landlord_cards
+        infoset.card_play_action_seq = tuple(self.card_play_action_seq)
+        infoset.action_seq_array = self.get_action_seq_array().copy()
 
-        return deepcopy(self.info_sets[self.acting_player_position])
+        return infoset
 
 class InfoSet(object):
     """
@@ -342,33 +446,113 @@ class InfoSet(object):
     includes all the information in the current situation,
     such as the hand cards of the three players, the
     historical moves, etc.
+
+    The fields in `_DerivedFields` are computed from the per-seat
+    state the first time they are read and then kept.
     """
+    __slots__ = ('player_position', 'seat', 'hands', 'hand_counts', 'hand_arrays',
+                 'played', 'played_counts', 'played_arrays',
+                 'last_moves', 'last_move_arrays',
+                 'three_landlord_cards', 'card_play_action_seq',
+                 'action_seq_array', 'legal_action_ids', 'last_move', 'last_two_moves',
+                 'last_pid', 'bomb_num',
+                 # Derived fields
+                 'player_hand_cards', 'num_cards_left_dict',
+                 'other_hand_cards', 'legal_actions', 'legal_action_id_set',
+                 'last_move_dict', 'played_cards', 'all_handcards')
+
     def __init__(self, player_position):
         # The player position, i.e., landlord, landlord_down, or landlord_up
         self.player_position = player_position
-        # The hand cands of the current player. A list.
-        self.player_hand_cards = None
-        # The number of cards left for each player. It is a dict with str-->int 
-        self.num_cards_left_dict = None
-        # The three landload cards. A list.
+        # The index of the player position in `Positions`
+        self.seat = Position2Seat[player_position]
+        # The hand cards of the three players, by seat. A tuple of tuples
+        self.hands = None
+        # The number of cards of each rank in the hands, by seat. A
+        # (3, 15) array
+        self.hand_counts = None
+        # The card matrices of the hands, by seat. A (3, 54) array
+        self.hand_arrays = None
+        # The played cards of the three players, by seat. A tuple of tuples
+        self.played = None
+        # The number of cards of each rank played so far, by seat. A
+        # (3, 15) array
+        self.played_counts = None
+        # The card matrices of the played cards, by seat. A (3, 54) array
+        self.played_arrays = None
+        # The last moves of the three players, by seat. A tuple of tuples
+        self.last_moves = None
+        # The card matrices of the last moves, by seat. A (3, 54) array
+        self.last_move_arrays = None
+        # The three landload cards. A tuple.
         self.three_landlord_cards = None
-        # The historical moves. It is a list of list
+        # The historical moves. It is a tuple of tuples
         self.card_play_action_seq = None
-        # The union of the hand cards of the other two players for the current player 
-        self.other_hand_cards = None
-        # The legal actions for the current move. It is a list of list
-        self.legal_actions = None
+        # The encoding of the last 15 moves. A 5x162 int8 array, see
+        # `GameEnv.get_action_seq_array`
+        self.action_seq_array = None
+        # The ids of the legal actions in the global action space,
+        # see `douzero.env.action_space`. A numpy array
+        self.legal_action_ids = None
         # The most recent valid move
         self.last_move = None
         # The most recent two moves
         self.last_two_moves = None
-        # The last moves for all the postions
-        self.last_move_dict = None
-        # The played cands so far. It is a list.
-        self.played_cards = None
-        # The hand cards of all the players. It is a dict. 
-        self.all_handcards = None
         # Last player position that plays a valid move, i.e., not `pass`
         self.last_pid = None
         # The number of bombs played so far
         self.bomb_num = None
+
+        # Derived fields:
+        # player_hand_cards: The hand cands of the current player. A list.
+        # num_cards_left_dict: The number of cards left for each player.
+        #     It is a dict with str-->int
+        # other_hand_cards: The union of the hand cards of the other
+        #     two players for the current player
+        # legal_actions: The legal actions for the current move. It is
+        #     a list of list
+        # legal_action_id_set: The ids of the legal actions as a
+        #     frozenset for membership checks
+        # last_move_dict: The last moves for all the postions. It is a
+        #     dict with str-->tuple
+        # played_cards: The played cands so far. It is a dict with
+        #     str-->tuple
+        # all_handcards: The hand cards of all the players. It is a dict.
+
+    def __getattr__(self, name):
+        # Only called when a slot has not been set, i.e., for the
+        # derived fields that have not been read yet
+        derive = _DerivedFields.get(name)
+        if derive is None:
+            raise AttributeError(name)
+        value = derive(self)
+        setattr(self, name, value)
+        return value
+
+    def is_legal_action(self, action):
+        """
+        Whether a move (a list of cards) is one of the legal actions.
+        The move is looked up by id, so this does not scan the list.
+        """
+        return action2id(action) in self.legal_action_id_set
+
+def _other_hand_cards(infoset):
+    other_hand_cards = []
+    for seat, hand_cards in enumerate(infoset.hands):
+        if seat != infoset.seat:
+            other_hand_cards += hand_cards
+    return other_hand_cards
+
+_DerivedFields = {
+    'player_hand_cards': lambda infoset: list(infoset.hands[infoset.seat]),
+    'num_cards_left_dict': lambda infoset: {
+        pos: len(hand_cards) for pos, hand_cards in zip(Positions, infoset.hands)},
+    'other_hand_cards': _other_hand_cards,
+    'legal_actions': lambda infoset: [
+        id2action(action_id) for action_id in infoset.legal_action_ids],
+    'legal_action_id_set': lambda infoset: frozenset(infoset.legal_action_ids.tolist()),
+    'last_move_dict': lambda infoset: dict(zip(Positions, infoset.last_moves)),
+    'played_cards': lambda infoset: dict(zip(Positions, infoset.played)),
+    'all_handcards': lambda infoset: {
+        pos: list(hand_cards) for pos, hand_cards in zip(Positions, infoset.hands)},
+}
@@ -10,8 +10,41 @@ def is_continuous_seq(move):
         i += 1
     return True
 
+# Sorted move tuple -> action id and action id -> move type, taken
+# from the action space the first time a move is classified
+_Action2Id = None
+_ActionMoveTypes = None
+
+def _load_move_types():
+    global _Action2Id, _ActionMoveTypes
+    from douzero.env.action_space import Action2Id, ACTION_MOVE_TYPES
+    _Action2Id = Action2Id
+    _ActionMoveTypes = ACTION_MOVE_TYPES
+
 # return the type of the move
 def get_move_type(move):
+    """
+    Table lookup of the type of a sorted move. Every move of the
+    action space is classified once with `classify_move`; other
+    moves (e.g., unsorted ones) are classified on the fly.
+    """
+    if _Action2Id is None:
+        _load_move_types()
+    action_id = _Action2Id.get(tuple(move))
+    if action_id is None:
+        return classify_move(move)
+    return dict(_ActionMoveTypes[action_id])
+
+def get_move_type_by_id(action_id):
+    """
+    The type of the move with the given action id.
+    """
+    if _ActionMoveTypes is None:
+        _load_move_types()
+    return dict(_ActionMoveTypes[action_id])
+
+# the reference classification behind `get_move_type`
+def classify_move(move):
     move_size = len(move)
     move_dict = collections.Counter(move)
 
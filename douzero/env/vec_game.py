@@ -0,0 +1,305 @@
+"""
+A vectorized game engine that plays many games at once. The
+state of N games is kept as arrays (struct of arrays): the number
+of cards of each rank in the hands as a (N, 3, 15) array, the
+last moves as a (N, 15) array of action ids, etc. The legal moves
+of all the games are computed together as a (N, NUM_ACTIONS)
+mask over the global action space, see `douzero.env.action_space`,
+and `step` plays one action per game.
+
+The rules are the ones of `GameEnv`, i.e., the moves of
+`MovesGener` filtered by `move_selector`, so both engines give
+the same legal moves. The seats follow `game.Positions`.
+"""
+import numpy as np
+
+from douzero.env import move_detector as md
+from douzero.env.action_space import ACTION_ARRAYS, ACTION_COUNTS, \
+    ACTION_LENS, ACTION_TYPES, NUM_ACTIONS, PASS_ID
+from douzero.env.encoding import cards2counts_batch, counts2array
+from douzero.env.game import NUM_HISTORY_MOVES, Positions, Position2Seat
+from douzero.env.utils import MIN_SINGLE_CARDS, MIN_PAIRS, MIN_TRIPLES
+
+LANDLORD = Position2Seat['landlord']
+LANDLORD_UP = Position2Seat['landlord_up']
+LANDLORD_DOWN = Position2Seat['landlord_down']
+
+# The seat that plays after each seat: landlord -> landlord_down
+# -> landlord_up -> landlord
+NextSeat = np.zeros(3, dtype=np.int64)
+NextSeat[LANDLORD] = LANDLORD_DOWN
+NextSeat[LANDLORD_DOWN] = LANDLORD_UP
+NextSeat[LANDLORD_UP] = LANDLORD
+
+_Deck = np.array([i for i in range(3, 15) for _ in range(4)]
+                 + [17 for _ in range(4)] + [20, 30])
+
+def _serial_members(counts, num, length):
+    """
+    The actions that hold `length` consecutive ranks of 3 to A
+    with exactly `num` cards each.
+    """
+    has_num = np.zeros((counts.shape[0], 13), dtype=np.int64)
+    has_num[:, 1:] = np.cumsum(counts[:, :12] == num, axis=1)
+    return (has_num[:, length:] - has_num[:, :-length] == length).any(axis=1)
+
+def _build_families():
+    """
+    Group the actions into the families of moves that can follow
+    each other, i.e., the moves that `MovesGener` generates for a
+    given type (and length) of the rival move. A move can be in
+    several families, e.g., 333444555666 is a serial triple of
+    length 4 and a serial 3+1 of length 3. Within a family a move
+    beats another one if its key, the rank that `move_selector`
+    compares, is higher.
+    """
+    counts = ACTION_COUNTS.astype(np.int64)
+    size = counts.sum(axis=1)
+    num_ranks = (counts > 0).sum(axis=1)
+    min_rank = np.argmax(counts > 0, axis=1)
+    max_rank = 14 - np.argmax(counts[:, ::-1] > 0, axis=1)
+    num_triples = (counts == 3).sum(axis=1)
+    num_pairs = (counts == 2).sum(axis=1)
+    num_fours = (counts == 4).sum(axis=1)
+    triple_key = 14 - np.argmax(counts[:, ::-1] == 3, axis=1)
+    four_key = 14 - np.argmax(counts[:, ::-1] == 4, axis=1)
+    no_high_ranks = counts[:, 12:].sum(axis=1) == 0
+    is_run = no_high_ranks & (max_rank - min_rank + 1 == num_ranks)
+    king_bomb = (counts[:, 13] == 1) & (counts[:, 14] == 1) & (size == 2)
+
+    families = {}
+    families[md.TYPE_1_SINGLE, 1] = (size == 1, min_rank)
+    families[md.TYPE_2_PAIR, 1] = ((size == 2) & (num_ranks == 1), min_rank)
+    families[md.TYPE_3_TRIPLE, 1] = ((size == 3) & (num_ranks == 1), min_rank)
+    families[md.TYPE_4_BOMB, 1] = (((size == 4) & (num_ranks == 1)) | king_bomb, min_rank)
+    families[md.TYPE_6_3_1, 1] = ((size == 4) & (num_triples == 1), triple_key)
+    families[md.TYPE_7_3_2, 1] = ((size == 5) & (num_triples == 1) & (num_pairs == 1), triple_key)
+    for length in range(MIN_SINGLE_CARDS, 13):
+        families[md.TYPE_8_SERIAL_SINGLE, length] = (
+            is_run & (num_ranks == length) & (size == length), min_rank)
+    for length in range(MIN_PAIRS, 13):
+        families[md.TYPE_9_SERIAL_PAIR, length] = (
+            is_run & (num_ranks == length) & (num_pairs == length), min_rank)
+    for length in range(MIN_TRIPLES, 13):
+        families[md.TYPE_10_SERIAL_TRIPLE, length] = (
+            is_run & (num_ranks == length) & (num_triples == length), min_rank)
+        # The kickers are any cards outside of the serial ranks
+        families[md.TYPE_11_SERIAL_3_1, length] = (
+            (size == 4 * length) & _serial_members(counts, 3, length), triple_key)
+        families[md.TYPE_12_SERIAL_3_2, length] = (
+            (size == 5 * length) & (num_triples == length) & (num_pairs == length)
+            & (num_ranks == 2 * length) & _serial_members(counts, 3, length), triple_key)
+    families[md.TYPE_13_4_2, 1] = ((size == 6) & (num_fours == 1), four_key)
+    families[md.TYPE_14_4_22, 1] = (
+        (size == 8) & (num_fours == 1) & (num_pairs == 2) & (num_ranks == 3), four_key)
+
+    # The king bomb cannot be followed and the moves that
+    # `get_move_type` does not recognize can only be followed by
+    # bombs, so they get families without members
+    families[md.TYPE_5_KING_BOMB, 1] = (np.zeros(NUM_ACTIONS, dtype=bool), min_rank)
+    families[md.TYPE_15_WRONG, 1] = (np.zeros(NUM_ACTIONS, dtype=bool), min_rank)
+
+    # The candidates of each family: its members, and the bombs
+    # unless the family is made of bombs or is the king bomb, with
+    # their keys. Bombs beat any other move
+    bombs = np.nonzero(families[md.TYPE_4_BOMB, 1][0])[0]
+    keys = list(families)
+    candidates, candidate_keys = [], []
+    for move_type, length in keys:
+        members, member_keys = families[move_type, length]
+        members = np.nonzero(members)[0]
+        member_keys = member_keys[members]
+        if move_type not in (md.TYPE_4_BOMB, md.TYPE_5_KING_BOMB):
+            members = np.concatenate((members, bombs))
+            member_keys = np.concatenate((member_keys, np.full(len(bombs), 127)))
+        candidates.append(members)
+        candidate_keys.append(member_keys.astype(np.int8))
+
+    # The family and the key of every action as the rival move. They
+    # follow `get_move_type`, as the engine does
+    family_index = {key: index for index, key in enumerate(keys)}
+    wrong = family_index[md.TYPE_15_WRONG, 1]
+    rival_families = np.full(NUM_ACTIONS, wrong, dtype=np.int64)
+    rival_keys = np.zeros(NUM_ACTIONS, dtype=np.int8)
+    for action_id in range(NUM_ACTIONS):
+        key = int(ACTION_TYPES[action_id]), int(ACTION_LENS[action_id])
+        if key in family_index:
+            rival_families[action_id] = family_index[key]
+            rival_keys[action_id] = families[key][1][action_id]
+
+    return candidates, candidate_keys, rival_families, rival_keys
+
+_Candidates, _CandidateKeys, _RivalFamilies, _RivalKeys = _build_families()
+
+# The card matrices of all the actions and of the candidates of
+# each family, transposed for `_playable`
+_ActionArraysT = np.ascontiguousarray(ACTION_ARRAYS.T, dtype=np.float32)
+_CandidateArraysT = [np.ascontiguousarray(_ActionArraysT[:, candidates])
+                     for candidates in _Candidates]
+
+def _playable(missing, action_arrays):
+    """
+    Whether each action can be made from each hand, given the
+    complements of the card matrices of the hands and the
+    (transposed) card matrices of the actions. In the card matrix
+    a rank with n cards has its first n entries set, so an action
+    fits in a hand if it has no entry where the hand has none,
+    i.e., if the product of the two matrices is 0.
+    """
+    return np.matmul(missing, action_arrays) == 0
+
+def _nonzero(mask):
+    # Faster than `np.nonzero` on 2D masks
+    return np.divmod(np.flatnonzero(mask), mask.shape[1])
+
+class VecGameEnv(object):
+    """
+    Plays `num_games` games at once. The games are dealt with
+    `reset` (or `card_play_init`) and all move on with `step`, one
+    action id per game. Finished games do not move anymore; their
+    `game_over` flag is set and `winner` holds the winning side
+    (`LANDLORD`, or -1 for the farmers; -2 while playing).
+    """
+    def __init__(self, num_games):
+        self.num_games = num_games
+        self.hand_counts = np.zeros((num_games, 3, 15), dtype=np.int8)
+        self.played_counts = np.zeros((num_games, 3, 15), dtype=np.int8)
+        # The last moves as action ids, oldest first. Pass (0) is
+        # also used to pad the games with fewer moves
+        self.history = np.zeros((num_games, NUM_HISTORY_MOVES), dtype=np.int64)
+        self.num_moves = np.zeros(num_games, dtype=np.int64)
+        self.acting_seat = np.zeros(num_games, dtype=np.int64)
+        self.last_seat = np.zeros(num_games, dtype=np.int64)
+        self.bomb_num = np.zeros(num_games, dtype=np.int64)
+        self.game_over = np.zeros(num_games, dtype=bool)
+        self.winner = np.full(num_games, -2, dtype=np.int64)
+
+    def reset(self, rng=None):
+        """
+        Deal new games with random decks, in the same way as
+        `Env.reset`: the landlord gets the first 20 cards, the
+        landlord_up the next 17 and the landlord_down the last 17.
+        """
+        if rng is None:
+            rng = np.random
+        decks = _Deck[np.argsort(rng.random_sample((self.num_games, 54)), axis=1)]
+        self.card_play_init([{'landlord': deck[:20],
+                              'landlord_up': deck[20:37],
+                              'landlord_down': deck[37:54]}
+                             for deck in decks])
+
+    def card_play_init(self, card_play_data_list):
+        """
+        Start the games from a list of deals in the format of
+        `GameEnv.card_play_init`.
+        """
+        hands = [card_play_data[position]
+                 for card_play_data in card_play_data_list
+                 for position in Positions]
+        self.hand_counts[:] = cards2counts_batch(hands).reshape(self.num_games, 3, 15)
+        self.played_counts[:] = 0
+        self.history[:] = PASS_ID
+        self.num_moves[:] = 0
+        self.acting_seat[:] = LANDLORD
+        self.last_seat[:] = LANDLORD
+        self.bomb_num[:] = 0
+        self.game_over[:] = False
+        self.winner[:] = -2
+
+    def rival_move_ids(self):
+        """
+        The moves to beat, i.e., the last move that is not `pass`
+        unless two players passed in a row (then it is pass).
+        """
+        last, second_last = self.history[:, -1], self.history[:, -2]
+        return np.where(last == PASS_ID, second_last, last)
+
+    def legal_actions(self):
+        """
+        The legal actions of the acting player of every game as two
+        arrays of the same length: the indices of the games and the
+        action ids, ordered by game. Finished games have no legal
+        action. A leading player can play any move of the hand. The
+        other games are grouped by the family of the rival move and
+        only the candidates of the family are checked.
+        """
+        games = np.arange(self.num_games)
+        hand_counts = self.hand_counts[games, self.acting_seat]
+        missing = 1 - counts2array(hand_counts).astype(np.float32)
+        game_ids, action_ids = [], []
+
+        rival_ids = self.rival_move_ids()
+        active = ~self.game_over
+        leading = np.nonzero(active & (rival_ids == PASS_ID))[0]
+        if len(leading) > 0:
+            playable = _playable(missing[leading], _ActionArraysT)
+            playable[:, PASS_ID] = False
+            rows, columns = _nonzero(playable)
+            game_ids.append(leading[rows])
+            action_ids.append(columns)
+
+        following = np.nonzero(active & (rival_ids != PASS_ID))[0]
+        game_ids.append(following)
+        action_ids.append(np.full(len(following), PASS_ID))
+        families = _RivalFamilies[rival_ids[following]]
+        for family in np.unique(families):
+            family_games = following[families == family]
+            candidates = _Candidates[family]
+            if len(candidates) == 0:
+                continue
+            beats = _CandidateKeys[family] > _RivalKeys[rival_ids[family_games]][:, None]
+            playable = _playable(missing[family_games], _CandidateArraysT[family])
+            rows, columns = _nonzero(beats & playable)
+            game_ids.append(family_games[rows])
+            action_ids.append(candidates[columns])
+
+        game_ids = np.concatenate(game_ids)
+        action_ids = np.concatenate(action_ids)
+        order = np.argsort(game_ids, kind='stable')
+        return game_ids[order], action_ids[order]
+
+    def legal_action_mask(self):
+        """
+        The legal actions of every game as a (N, NUM_ACTIONS) boolean
+        mask, see `legal_actions`.
+        """
+        mask = np.zeros((self.num_games, NUM_ACTIONS), dtype=bool)
+        mask[self.legal_actions()] = True
+        return mask
+
+    def step(self, action_ids):
+        """
+        Play one action id per game. The actions of the finished
+        games are ignored.
+        """
+        action_ids = np.asarray(action_ids, dtype=np.int64)
+        active = ~self.game_over
+        games = np.nonzero(active)[0]
+        action_ids = action_ids[games]
+        seats = self.acting_seat[games]
+        counts = ACTION_COUNTS[action_ids]
+
+        self.hand_counts[games, seats] -= counts
+        self.played_counts[games, seats] += counts
+        self.history[games, :-1] = self.history[games, 1:]
+        self.history[games, -1] = action_ids
+        self.num_moves[games] += 1
+
+        played = action_ids != PASS_ID
+        self.last_seat[games[played]] = seats[played]
+        bomb = np.isin(ACTION_TYPES[action_ids], (md.TYPE_4_BOMB, md.TYPE_5_KING_BOMB))
+        self.bomb_num[games[bomb]] += 1
+
+        done = self.hand_counts[games, seats].sum(axis=1) == 0
+        self.game_over[games[done]] = True
+        self.winner[games[done]] = np.where(seats[done] == LANDLORD, LANDLORD, -1)
+        self.acting_seat[games[~done]] = NextSeat[seats[~done]]
+
+    def get_scores(self):
+        """
+        The scores of the landlord in the finished games, as in
+        `GameEnv.update_num_wins_scores`: +/-2 times 2 to the number
+        of bombs (the farmers score half of it each).
+        """
+        sign = np.where(self.winner == LANDLORD, 1, -1)
+        return np.where(self.game_over, sign * 2 * 2 ** self.bomb_num, 0)
@@ -1,3 +1,5 @@
+import os
+
 import torch
 import numpy as np
 
@@ -7,7 +9,11 @@ def _load_model(position, model_path):
     from douzero.dmc.models import model_dict
     model = model_dict[position]()
     model_state_dict = model.state_dict()
-    if torch.cuda.is_available():
+    if os.path.isdir(model_path):
+        # A flat checkpoint of the training, see `douzero.dmc.checkpoint`
+        from douzero.dmc.checkpoint import load_flat_checkpoint
+        pretrained = load_flat_checkpoint(model_path, optimizers=False)['model_state_dict'][position]
+    elif torch.cuda.is_available():
         pretrained = torch.load(model_path, map_location='cuda:0')
     else:
         pretrained = torch.load(model_path, map_location='cpu')
@@ -28,13 +34,14 @@ class DeepAgent:
         if len(infoset.legal_actions) == 1:
             return infoset.legal_actions[0]
 
-        obs = get_obs(infoset) 
+        obs = get_obs(infoset, factored=True)
 
         z_batch = torch.from_numpy(obs['z_batch']).float()
         x_batch = torch.from_numpy(obs['x_batch']).float()
+        action_batch = torch.from_numpy(obs['action_batch']).float()
         if torch.cuda.is_available():
-            z_batch, x_batch = z_batch.cuda(), x_batch.cuda()
-        y_pred = self.model.forward(z_batch, x_batch, return_value=True)['values']
+            z_batch, x_batch, action_batch = z_batch.cuda(), x_batch.cuda(), action_batch.cuda()
+        y_pred = self.model.forward(z_batch, x_batch, return_value=True, actions=action_batch)['values']
         y_pred = y_pred.detach().cpu().numpy()
 
         best_action_index = np.argmax(y_pred, axis=0)[0]
@@ -0,0 +1,35 @@
+"""
+`FileWriter` writes the logged records from a background thread.
+`close` must write the records logged before it and return, even
+when records are logged while it runs or after it.
+"""
+import csv
+
+from douzero.dmc.file_writer import FileWriter
+
+def _logged_frames(writer):
+    with open(writer.paths['logs']) as f:
+        rows = csv.DictReader((line for line in f if not line.startswith('#')),
+                              fieldnames=writer.fieldnames)
+        return [int(row['frames']) for row in rows]
+
+def test_log_after_close(tmp_path):
+    writer = FileWriter(xpid='xp', rootdir=str(tmp_path), flush_interval=0.05)
+    for frames in range(3):
+        writer.log({'frames': frames})
+    writer.close()
+    writer.log({'frames': 3})
+    assert not writer._thread.is_alive()
+    assert _logged_frames(writer) == [0, 1, 2]
+
+def test_records_queued_after_close(tmp_path):
+    writer = FileWriter(xpid='xp', rootdir=str(tmp_path), flush_interval=60)
+    writer.log({'frames': 0})
+    # A learner thread that logs while `close` runs queues its
+    # record behind the end of the log
+    writer._queue.put(None)
+    writer._queue.put({'_tick': 1, '_time': 0., 'frames': 1})
+    writer.close()
+    writer._thread.join(timeout=5)
+    assert not writer._thread.is_alive()
+    assert _logged_frames(writer) == [0]
@@ -0,0 +1,46 @@
+"""
+The count-vector move generator must give the same moves as the
+legacy `MovesGener` based one, on random hands and rival moves.
+"""
+import random
+
+from douzero.env.action_space import ACTIONS, NUM_ACTIONS
+from douzero.env.count_move_generator import gen_legal_moves
+from douzero.env.game import _gen_legal_card_play_actions
+
+Deck = [i for i in range(3, 15) for _ in range(4)] + [17 for _ in range(4)] + [20, 30]
+
+def _random_case(rng):
+    """ A random hand and a rival move: pass, a move of another hand or any action """
+    deck = Deck.copy()
+    rng.shuffle(deck)
+    size = rng.choice([20, 17, rng.randint(1, 20)])
+    hand = sorted(deck[:size])
+    other = sorted(deck[size:size + 20])
+    r = rng.random()
+    if r < 0.15:
+        rival_move = []
+    elif r < 0.7:
+        rival_move = sorted(rng.choice(_gen_legal_card_play_actions(other, [])))
+    else:
+        rival_move = list(ACTIONS[rng.randrange(NUM_ACTIONS)])
+    return hand, rival_move
+
+def _check(hand, rival_move):
+    legacy = _gen_legal_card_play_actions(list(hand), list(rival_move))
+    moves = [tuple(move) for move in gen_legal_moves(list(hand), list(rival_move))]
+    assert len(moves) == len(set(moves)), (hand, rival_move)
+    assert set(moves) == set(tuple(move) for move in legacy), (hand, rival_move)
+
+def test_random_hands():
+    rng = random.Random(0)
+    for _ in range(3000):
+        _check(*_random_case(rng))
+
+def test_full_hand_against_every_action():
+    rng = random.Random(1)
+    deck = Deck.copy()
+    rng.shuffle(deck)
+    hand = sorted(deck[:20])
+    for action in ACTIONS:
+        _check(hand, list(action))
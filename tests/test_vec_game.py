@@ -0,0 +1,67 @@
+"""
+`VecGameEnv` must replay the games of `GameEnv` move for move: the
+games are recorded with `GameEnv` and a seeded random policy, then
+replayed together in `VecGameEnv`, which must give the same acting
+seat and legal actions at every step and the same results.
+"""
+import numpy as np
+
+from douzero.env.action_space import action2id, id2action
+from douzero.env.game import GameEnv, Positions, Position2Seat
+from douzero.env.vec_game import VecGameEnv, _Deck
+
+class RandomPlayer:
+    def __init__(self, rng):
+        self.rng = rng
+
+    def act(self, infoset):
+        return id2action(self.rng.choice(infoset.legal_action_ids))
+
+def _record_game(rng):
+    """ Play a game with `GameEnv` and record every step """
+    deck = rng.permutation(_Deck).tolist()
+    deal = {'landlord': sorted(deck[:20]),
+            'landlord_up': sorted(deck[20:37]),
+            'landlord_down': sorted(deck[37:54]),
+            'three_landlord_cards': sorted(deck[17:20])}
+    env = GameEnv({position: RandomPlayer(rng) for position in Positions})
+    env.card_play_init(deal)
+    steps = []
+    while not env.game_over:
+        infoset = env.game_infoset
+        seat = Position2Seat[infoset.player_position]
+        legal_action_ids = set(infoset.legal_action_ids.tolist())
+        env.step()
+        steps.append((seat, legal_action_ids, env.card_play_action_seq[-1]))
+    result = dict(winner=env.get_winner(), bomb_num=env.bomb_num,
+                  score=env.num_scores['landlord'])
+    return deal, steps, result
+
+def test_replay_recorded_games():
+    rng = np.random.RandomState(0)
+    games = [_record_game(rng) for _ in range(100)]
+    vec_env = VecGameEnv(len(games))
+    vec_env.card_play_init([deal for deal, _, _ in games])
+
+    step = 0
+    while not vec_env.game_over.all():
+        mask = vec_env.legal_action_mask()
+        action_ids = np.zeros(len(games), dtype=np.int64)
+        for i, (_, steps, _) in enumerate(games):
+            if step >= len(steps):
+                assert vec_env.game_over[i] and not mask[i].any()
+                continue
+            seat, legal_action_ids, action = steps[step]
+            assert not vec_env.game_over[i]
+            assert vec_env.acting_seat[i] == seat
+            assert set(np.nonzero(mask[i])[0].tolist()) == legal_action_ids, (i, step)
+            action_ids[i] = action2id(action)
+        vec_env.step(action_ids)
+        step += 1
+
+    scores = vec_env.get_scores()
+    for i, (_, steps, result) in enumerate(games):
+        assert vec_env.num_moves[i] == len(steps)
+        assert (vec_env.winner[i] == Position2Seat['landlord']) == (result['winner'] == 'landlord')
+        assert vec_env.bomb_num[i] == result['bomb_num']
+        assert scores[i] == result['score']